@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###############################################################################
+# Benchmarks sync-git-vss.py against the ss emulator (bench/ss.py).           #
+###############################################################################
+# Each scenario builds a synthetic git repository, syncs it to a fresh        #
+# emulated VSS database and then measures one sync run: its ss calls, its     #
+# wall time and the time spent inside ss. The resulting VSS tree is checked   #
+# against git HEAD. The failure scenarios inject a fault into the measured    #
+# sync, which has to stop cleanly, and check that a sync without the fault    #
+# brings VSS to git HEAD. Runs on Linux with no network.                      #
+#                                                                             #
+# Options:                                                                    #
+#   --files=N        files in the generated repository [200];                 #
+#   --depth=N        directory levels [3];                                    #
+#   --fanout=N       sub-directories per directory [4];                       #
+#   --commits=N      commits replayed by the history scenario [10];           #
+#   --churn=N        files modified per commit (plus N/4 added and deleted)   #
+#                    [10];                                                    #
+#   --renames=N      files renamed by the renames scenario [10];              #
+#   --latency=S      seconds each ss call sleeps [0];                         #
+#   --locked=N       every N-th ss call fails on a lock, to be retried [0];   #
+#   --seed=N         random seed of the generators [1];                       #
+#   --scenario=A,B   scenarios to run [import,incremental,history,renames,    #
+#                    file-to-dir,dry-run,jobs-failure,checkout-failure];      #
+#   --sync=OPTS      options passed to sync-git-vss.py, e.g. "--batch";       #
+#   --in-process     run the syncs through git_vss.SyncEngine in this         #
+#                    process instead of starting sync-git-vss.py;             #
+#   --stream-queue=N with --in-process, changes git lists ahead of VSS, few   #
+#                    to fail syncs while git is still listing [1000];         #
+#   --timeout=S      seconds a sync may take before it is deemed hung [600];  #
+#   --save=FILE      write the results as JSON, to use as a baseline;         #
+#   --baseline=FILE  compare with results saved earlier;                      #
+#   --keep           keep the working folders.                                #
+###############################################################################
+
+###############################################################################
+# imports                                                                     #
+###############################################################################
+import sys
+import os
+import json
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import hashlib
+import traceback
+import threading
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import git_vss
+
+###############################################################################
+# cli arguments                                                               #
+###############################################################################
+opts = dict()
+for arg in sys.argv[1:]:
+    if arg.startswith("--"):
+        name, sep, value = arg[2:].partition("=")
+        opts[name] = value
+    else:
+        print ("Unexpected argument " + arg)
+        sys.exit(1)
+
+###############################################################################
+# settings                                                                    #
+###############################################################################
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+script    = os.path.join(os.path.dirname(bench_dir), "sync-git-vss.py")
+settings  = {
+    "files":   int(opts.get("files") or 200),
+    "depth":   int(opts.get("depth") or 3),
+    "fanout":  int(opts.get("fanout") or 4),
+    "commits": int(opts.get("commits") or 10),
+    "churn":   int(opts.get("churn") or 10),
+    "renames": int(opts.get("renames") or 10),
+    "latency": float(opts.get("latency") or 0),
+    "locked":  int(opts.get("locked") or 0),
+    "seed":    int(opts.get("seed") or 1),
+    "sync":    opts.get("sync") or "",
+    "in_process": "in-process" in opts,
+    "stream_queue": int(opts.get("stream-queue") or git_vss.stream_queue),
+    "timeout": float(opts.get("timeout") or 600),
+}
+scenario_names = (opts.get("scenario") or "import,incremental,history,renames,file-to-dir,dry-run,jobs-failure,checkout-failure").split(",")
+vss_proj = "$/Bench"
+vss_user = "bench"
+git_branch = "master"
+
+###############################################################################
+# git helpers                                                                 #
+###############################################################################
+def git(src, *args):
+    subprocess.run(["git"] + list(args), cwd=src, check=True, stdout=subprocess.DEVNULL)
+def git_output(src, *args):
+    return subprocess.run(["git"] + list(args), cwd=src, check=True, stdout=subprocess.PIPE).stdout.decode("utf8").strip()
+def git_files(src):
+    out = subprocess.run(["git", "ls-files", "-z"], cwd=src, check=True, stdout=subprocess.PIPE).stdout
+    return [path for path in out.decode("utf8").split("\0") if path != ""]
+def git_commit(src, msg):
+    git(src, "add", "-A")
+    git(src, "commit", "-q", "-m", msg)
+
+###############################################################################
+# generators---synthetic repositories and histories                           #
+###############################################################################
+def gen_dirs():
+    dirs = [""]
+    level = [""]
+    for d in range(settings["depth"]):
+        level = [path_join(parent, "d{}_{}".format(d, i)) for parent in level for i in range(settings["fanout"])]
+        dirs.extend(level)
+    return dirs
+def path_join(parent, name):
+    return name if parent == "" else parent + "/" + name
+def gen_content(rand, name):
+    # long enough for git to detect renames of slightly modified files
+    return "".join("{} line {} {}\n".format(name, i, rand.random()) for i in range(rand.randint(5, 40)))
+def gen_file(src, rand, dirs):
+    while True:
+        path = path_join(rand.choice(dirs), "f{}.txt".format(rand.randrange(1000000)))
+        if not os.path.exists(os.path.join(src, path)):
+            break
+    os.makedirs(os.path.dirname(os.path.join(src, path)), exist_ok=True)
+    with open(os.path.join(src, path), "w", encoding="utf8") as f:
+        f.write(gen_content(rand, path))
+    return path
+def gen_tree(src, rand):
+    os.makedirs(src)
+    git(src, "init", "-q", "-b", git_branch)
+    git(src, "config", "user.email", "bench@example.com")
+    git(src, "config", "user.name", "bench")
+    dirs = gen_dirs()
+    for i in range(settings["files"]):
+        gen_file(src, rand, dirs)
+    git_commit(src, "initial tree")
+def gen_churn(src, rand):
+    # modify churn files, add and delete a quarter as many
+    files = git_files(src)
+    churn = min(settings["churn"], len(files))
+    for path in rand.sample(files, churn):
+        with open(os.path.join(src, path), "a", encoding="utf8") as f:
+            f.write("changed {}\n".format(rand.random()))
+    for i in range(churn // 4):
+        gen_file(src, rand, gen_dirs())
+    for path in rand.sample(files, churn // 4):
+        git(src, "rm", "-q", "-f", path)
+    git_commit(src, "churn")
+def gen_renames(src, rand):
+    # rename files within and across directories and move one directory
+    files = git_files(src)
+    dirs = gen_dirs()
+    for path in rand.sample(files, min(settings["renames"], len(files))):
+        if rand.random() < 0.5:
+            new_path = path_join(os.path.dirname(path), "r" + os.path.basename(path))
+        else:
+            new_path = path_join(rand.choice(dirs), "r" + os.path.basename(path))
+        if os.path.exists(os.path.join(src, new_path)):
+            continue
+        os.makedirs(os.path.dirname(os.path.join(src, new_path)), exist_ok=True)
+        git(src, "mv", path, new_path)
+    leaves = [path for path in dirs if path != "" and path.count("/") == settings["depth"] - 1 and os.path.isdir(os.path.join(src, path))]
+    if settings["depth"] > 0 and leaves:
+        leaf = rand.choice(leaves)
+        git(src, "mv", leaf, leaf + "_moved")
+    git_commit(src, "renames")
+def gen_file_to_dir(src, rand):
+    # replace files by folders of the same name, with a file in each
+    files = git_files(src)
+    for path in rand.sample(files, min(max(1, settings["churn"] // 4), len(files))):
+        git(src, "rm", "-q", "-f", path)
+        os.makedirs(os.path.join(src, path))
+        with open(os.path.join(src, path, "f.txt"), "w", encoding="utf8") as f:
+            f.write(gen_content(rand, path + "/f.txt"))
+    git_commit(src, "files to folders")
+def gen_delete_dir(src, rand):
+    # delete a whole folder
+    dirs = [path for path in gen_dirs() if path != "" and os.path.isdir(os.path.join(src, path))]
+    if dirs:
+        git(src, "rm", "-q", "-r", "-f", rand.choice(dirs))
+        git_commit(src, "delete folder")
+
+###############################################################################
+# scenarios---history committed between the first sync and the measured one   #
+###############################################################################
+def history_incremental(src, rand):
+    gen_churn(src, rand)
+def history_commits(src, rand):
+    for i in range(settings["commits"]):
+        gen_churn(src, rand)
+def history_delete_dir(src, rand):
+    gen_churn(src, rand)
+    gen_delete_dir(src, rand)
+scenarios = {
+    "import":      None,              # measures the first sync
+    "incremental": history_incremental,
+    "history":     history_commits,
+    "renames":     gen_renames,
+    "file-to-dir": gen_file_to_dir,
+    "dry-run":     None,              # the first sync, as a dry run
+    "jobs-failure":     history_delete_dir,
+    "checkout-failure": history_commits,
+}
+
+###############################################################################
+# faults---failure scenarios: sync options and environment of the measured    #
+# sync, and whether VSS still has to match its .gitcommit after it failed     #
+###############################################################################
+def fault_jobs(src):
+    # a permanent ss error while workers sync: the renames that start every
+    # delete, of files by the workers and of a folder by the main thread
+    return "--jobs=3", {"SS_CORRUPT": "rename"}, False
+def fault_checkout(src):
+    # git fails to check out a commit half way through the history
+    commit = git_output(src, "rev-parse", "HEAD~" + str(settings["commits"] // 2))
+    return "--checkpoint=1", {"GIT_FAIL_CHECKOUT": commit}, True
+faults = {
+    "jobs-failure":     fault_jobs,
+    "checkout-failure": fault_checkout,
+}
+
+###############################################################################
+# sync runs                                                                   #
+###############################################################################
+def emulator_bin(work):
+    path = os.path.join(work, "bin")
+    os.makedirs(path)
+    with open(os.path.join(path, "ss"), "w", encoding="utf8") as f:
+        f.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, os.path.join(bench_dir, "ss.py")))
+    os.chmod(os.path.join(path, "ss"), 0o755)
+    with open(os.path.join(path, "git"), "w", encoding="utf8") as f: # fails checkout $GIT_FAIL_CHECKOUT
+        f.write('#!/bin/sh\nif [ "$1" = checkout ] && [ -n "$GIT_FAIL_CHECKOUT" ] && [ "$2" = "$GIT_FAIL_CHECKOUT" ]; then\n'
+                '    echo "fatal: unable to read tree $2" >&2\n    exit 128\nfi\nexec "{}" "$@"\n'.format(shutil.which("git")))
+    os.chmod(os.path.join(path, "git"), 0o755)
+    return path
+def calls_count(db):
+    try:
+        with open(os.path.join(db, "calls.log"), "r", encoding="utf8") as f:
+            return sum(1 for line in f)
+    except FileNotFoundError:
+        return 0
+def sync_opts(sync):
+    # sync options as sync-git-vss.py parses them
+    result = dict()
+    for arg in sync.split():
+        name, sep, value = arg[2:].partition("=")
+        result[name] = value
+    return result
+def run_engine(clone, src, db, env, log, sync):
+    # the sync without the start-up of a new interpreter, its output (and that
+    # of the commands it runs) goes to log; threads it leaves running would
+    # keep a script from exiting or pile up in a process running many syncs,
+    # they count as a hang
+    git_vss.stream_queue = settings["stream_queue"]
+    before = set(threading.enumerate())
+    engine = git_vss.SyncEngine(clone, src, git_branch, vss_proj, vss_user, vss_user, opts=sync_opts(sync), sspath=db, env=env)
+    with open(log, "w", encoding="utf8") as f:
+        sys.stdout.flush()
+        saved = (os.dup(1), os.dup(2))
+        os.dup2(f.fileno(), 1)
+        os.dup2(f.fileno(), 2)
+        try:
+            engine.run()
+            returncode = 0
+        except git_vss.SyncError: # reported by the engine
+            returncode = 1
+        except Exception:
+            traceback.print_exc()
+            returncode = 1
+        try:
+            left = [thread for thread in threading.enumerate() if thread not in before]
+            if left:
+                print ("Sync left " + str(len(left)) + " threads running: " + ", ".join(thread.name for thread in left))
+                return -1
+            return returncode
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+def run_sync(work, src, db, log, sync="", fault_env=None):
+    # sync, if given, is added to --sync; hung syncs exit with -1
+    sync = (settings["sync"] + " " + sync).strip()
+    env = dict(os.environ)
+    env["PATH"] = os.path.join(work, "bin") + os.pathsep + env.get("PATH", "")
+    env["SSDIR"] = db
+    env["SSPATH"] = db
+    env["SSUSER"] = vss_user
+    env["SS_LATENCY"] = str(settings["latency"])
+    env["SS_LOCKED"] = str(settings["locked"])
+    env.update(fault_env or dict())
+    clone = os.path.join(work, "clone")
+    cmd = [sys.executable, script, clone, src, git_branch, vss_proj, vss_user, vss_user] + sync.split()
+    calls = calls_count(db)
+    start = time.perf_counter()
+    if settings["in_process"]:
+        returncode = run_engine(clone, src, db, env, log, sync)
+    else:
+        with open(log, "w", encoding="utf8") as f:
+            try:
+                returncode = subprocess.run(cmd, cwd=work, env=env, stdout=f, stderr=subprocess.STDOUT, timeout=settings["timeout"]).returncode
+            except subprocess.TimeoutExpired:
+                returncode = -1
+    wall = time.perf_counter() - start
+    if returncode == -1:
+        print ("Sync hung, see " + log)
+    elif returncode != 0 and fault_env is None:
+        print ("Sync failed, see " + log)
+    ss_time = 0.0
+    try:
+        with open(os.path.join(clone, ".git", "vss-sync-trace.json"), "r", encoding="utf8") as f:
+            kinds = json.load(f)["summary"]["kinds"]
+        ss_time = sum(stats["time"] for kind, stats in kinds.items() if kind.startswith("ss"))
+    except (OSError, ValueError, KeyError):
+        pass # no trace, e.g. the sync failed early
+    return {
+        "exit": returncode,
+        "calls": calls_count(db) - calls,
+        "wall": round(wall, 3),
+        "ss_time": round(ss_time, 3),
+    }
+def vss_items(db):
+    # path -> item of the files and projects in the VSS project
+    try:
+        with open(os.path.join(db, "emulator.json"), "r", encoding="utf8") as f:
+            items = json.load(f)["items"]
+    except FileNotFoundError: # no ss call changed the database
+        return dict()
+    prefix = vss_proj.lower()
+    return dict((item["path"][len(prefix) + 1:], item) for key, item in items.items()
+                if not item["deleted"] and (key == prefix or key.startswith(prefix + "/")))
+def check(src, db, commit=None):
+    # files in VSS against git HEAD, or commit, ignoring .gitcommit
+    vss = dict((path, item["hash"]) for path, item in vss_items(db).items() if item["type"] == "file")
+    vss.pop(".gitcommit", None)
+    git_tree = dict()
+    if commit is None:
+        for path in git_files(src):
+            with open(os.path.join(src, path), "rb") as f:
+                git_tree[path] = hashlib.sha1(f.read()).hexdigest()
+    else:
+        for path in git_output(src, "ls-tree", "-r", "--name-only", commit).splitlines():
+            data = subprocess.run(["git", "show", commit + ":" + path], cwd=src, check=True, stdout=subprocess.PIPE).stdout
+            git_tree[path] = hashlib.sha1(data).hexdigest()
+    return len([path for path in set(vss) | set(git_tree) if vss.get(path) != git_tree.get(path)])
+def vss_commit(db):
+    # the commit in .gitcommit
+    item = vss_items(db).get(".gitcommit")
+    return None if item is None or item.get("content") is None else item["content"].strip()
+def run_scenario(name):
+    rand = random.Random(settings["seed"])
+    work = tempfile.mkdtemp(prefix="bench-" + name + "-")
+    src = os.path.join(work, "src")
+    db = os.path.join(work, "db")
+    os.makedirs(db)
+    emulator_bin(work)
+    gen_tree(src, rand)
+    history = scenarios[name]
+    if history is not None:
+        first = run_sync(work, src, db, os.path.join(work, "setup.log"))
+        if first["exit"] != 0:
+            return work, dict(first, mismatches=-1, ok=False)
+        history(src, rand)
+    if name == "dry-run": # VSS has to stay as it was
+        result = run_sync(work, src, db, os.path.join(work, "sync.log"), "--dry-run")
+        result["mismatches"] = len(vss_items(db))
+        result["ok"] = result["exit"] == 0 and result["mismatches"] == 0
+        return work, result
+    if name not in faults:
+        result = run_sync(work, src, db, os.path.join(work, "sync.log"))
+        result["mismatches"] = check(src, db)
+        result["ok"] = result["exit"] == 0 and result["mismatches"] == 0
+        return work, result
+    sync, fault_env, consistent = faults[name](src)
+    result = run_sync(work, src, db, os.path.join(work, "sync.log"), sync, fault_env)
+    with open(os.path.join(work, "sync.log"), "r", encoding="utf8", errors="replace") as f:
+        clean = result["exit"] == 1 and "Traceback" not in f.read() # failed as a SyncError
+    if consistent and clean and check(src, db, vss_commit(db) or git_vss.git_empty_tree) != 0:
+        print ("VSS does not match its .gitcommit after the failure, see " + os.path.join(work, "sync.log"))
+        clean = False
+    recovery = run_sync(work, src, db, os.path.join(work, "recovery.log"), sync)
+    result["mismatches"] = check(src, db)
+    result["ok"] = clean and recovery["exit"] == 0 and result["mismatches"] == 0
+    return work, result
+
+###############################################################################
+# report                                                                      #
+###############################################################################
+def delta(value, base):
+    if base is None:
+        return ""
+    if base == 0:
+        return " (+{})".format(value) if value else " (=)"
+    return " ({:+.0f}%)".format(100.0 * (value - base) / base)
+def report(results, baseline):
+    base_results = baseline.get("results", dict()) if baseline else dict()
+    if baseline and baseline.get("settings") != settings:
+        print ("Warning: the baseline was recorded with different settings " + json.dumps(baseline.get("settings")))
+    print ("{:<16} {:>16} {:>18} {:>18}  {}".format("scenario", "ss calls", "wall (s)", "in ss (s)", "check"))
+    for name, result in results.items():
+        base = base_results.get(name, dict())
+        print ("{:<16} {:>16} {:>18} {:>18}  {}".format(
+            name,
+            str(result["calls"]) + delta(result["calls"], base.get("calls")),
+            "{:.3f}".format(result["wall"]) + delta(result["wall"], base.get("wall")),
+            "{:.3f}".format(result["ss_time"]) + delta(result["ss_time"], base.get("ss_time")),
+            "OK" if result["ok"] else "FAIL"))
+
+###############################################################################
+# main                                                                        #
+###############################################################################
+for name in scenario_names:
+    if name not in scenarios:
+        print ("Unknown scenario " + name + ", expected one of " + ",".join(scenarios))
+        sys.exit(1)
+baseline = None
+if "baseline" in opts:
+    with open(opts["baseline"], "r", encoding="utf8") as f:
+        baseline = json.load(f)
+results = dict()
+for name in scenario_names:
+    print ("Running " + name)
+    work, results[name] = run_scenario(name)
+    if "keep" in opts or not results[name]["ok"]:
+        print ("  working folder kept in " + work)
+    else:
+        shutil.rmtree(work, ignore_errors=True)
+report(results, baseline)
+if "save" in opts:
+    with open(opts["save"], "w", encoding="utf8") as f:
+        json.dump({"settings": settings, "results": results}, f, indent=1)
+sys.exit(0 if all(result["ok"] for result in results.values()) else 1)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+###############################################################################
+# A stand-in for VSS's ss.exe backed by a file-based model of the database.   #
+###############################################################################
+# Only the commands and messages sync-git-vss.py relies on are modelled:      #
+# projects, files, checkouts and deletions, plus the error strings the sync   #
+# parses ("already exists", "is not an existing filename or project", "You    #
+# currently have", "No items found under", "does not exist", ...).            #
+#                                                                             #
+# Environment:                                                                #
+#   SSDIR       folder holding the database (emulator.json) and calls.log;    #
+#   SSINI       together with SSUSER, selects the current project session;    #
+#   SS_LATENCY  seconds each call sleeps, to model a remote database;         #
+#   SS_FAIL_AT  fail the N-th logged call with a network error;               #
+#   SS_LOCKED   fail every N-th logged call as another user holds a lock;     #
+#   SS_CORRUPT  fail every call whose arguments contain this text, for good.  #
+###############################################################################
+import sys
+import os
+import json
+import time
+import fcntl
+import hashlib
+###############################################################################
+# emulator settings                                                           #
+###############################################################################
+err_vss = 100
+ok_vss  = 0
+state_file = "emulator.json"
+lock_file  = "emulator.lock"
+calls_file = "calls.log"
+content_max = 65536
+###############################################################################
+# database model                                                              #
+###############################################################################
+class SsError(Exception):
+    pass
+def db_dir():
+    return os.environ.get("SSDIR", os.getcwd())
+def db_load():
+    try:
+        with open(os.path.join(db_dir(), state_file), "r", encoding="utf8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"items": {"$": {"path": "$", "type": "project", "deleted": False}}, "cwd": {}}
+def db_save(db):
+    path = os.path.join(db_dir(), state_file)
+    with open(path + ".tmp", "w", encoding="utf8") as f:
+        json.dump(db, f)
+    os.replace(path + ".tmp", path)
+def session():
+    return os.environ.get("SSINI", "") + "|" + os.environ.get("SSUSER", "")
+def cur_proj(db):
+    return db["cwd"].get(session(), "$")
+def parent_of(path):
+    return path.rsplit("/", 1)[0] if "/" in path else "$"
+def resolve(db, name):
+    name = name.rstrip("/")
+    if name == "$" or name.startswith("$/"):
+        path = name
+    else:
+        path = cur_proj(db) + "/" + name
+    key = path.lower()
+    item = db["items"].get(key)
+    if item is not None:
+        return key, item["path"]
+    return key, db["items"][parent_of(key)]["path"] + "/" + path.rsplit("/", 1)[1] if parent_of(key) in db["items"] else path
+def lookup(db, name, kind=None, deleted_ok=False):
+    key, path = resolve(db, name)
+    item = db["items"].get(key)
+    if item is None or (kind is not None and item["type"] != kind):
+        raise SsError("{} is not an existing filename or project".format(name))
+    if item["deleted"] and not deleted_ok:
+        raise SsError("{} has been deleted".format(name))
+    return key, item
+def lookup_proj(db, name):
+    key, path = resolve(db, name)
+    item = db["items"].get(key)
+    if item is None or item["type"] != "project" or item["deleted"]:
+        raise SsError("Project {} does not exist".format(path))
+    return key, item
+def children(db, key, deleted=False):
+    prefix = key + "/"
+    return sorted((k, v) for k, v in db["items"].items()
+                  if k.startswith(prefix) and "/" not in k[len(prefix):] and (deleted or not v["deleted"]))
+def descendants(db, key):
+    prefix = key + "/"
+    return [k for k in db["items"] if k.startswith(prefix)]
+def new_item(db, parent, name, kind):
+    pkey = parent.lower()
+    key = pkey + "/" + name.lower()
+    old = db["items"].get(key)
+    if old is not None and not old["deleted"]:
+        raise SsError("{} already exists".format(name))
+    if old is not None:
+        raise SsError("{} has been deleted; recover it before reusing the name".format(name))
+    item = {"path": db["items"][pkey]["path"] + "/" + name, "type": kind, "deleted": False}
+    db["items"][key] = item
+    return key, item
+def local_read(name):
+    with open(os.path.join(os.getcwd(), name), "rb") as f:
+        data = f.read()
+    return data
+def comment(opts):
+    # -C@file reads the comment from a file, -C- is no comment
+    for opt in opts:
+        if opt.startswith("-C@"):
+            with open(opt[3:], "r", encoding="latin-1") as f:
+                return f.read()
+        if opt.startswith("-C") and opt != "-C-":
+            return opt[2:]
+    return None
+def store(item, data, text=None):
+    item["hash"] = hashlib.sha1(data).hexdigest()
+    item["comment"] = text
+    item["versions"] = item.get("versions", 0) + 1
+    item["content"] = data.decode("latin-1") if len(data) <= content_max else None
+def fetch(item, name):
+    if item.get("content") is not None:
+        with open(os.path.join(os.getcwd(), name), "wb") as f:
+            f.write(item["content"].encode("latin-1"))
+###############################################################################
+# commands                                                                    #
+###############################################################################
+def cmd_cd(db, items, opts):
+    key, item = lookup_proj(db, items[0])
+    db["cwd"][session()] = item["path"]
+def cmd_project(db, items, opts):
+    print ("Current project is " + cur_proj(db))
+def cmd_create(db, items, opts):
+    for name in items:
+        key, path = resolve(db, name)
+        if parent_of(key) not in db["items"] or db["items"][parent_of(key)]["deleted"]:
+            raise SsError("Project {} does not exist".format(parent_of(path)))
+        new_item(db, db["items"][parent_of(key)]["path"], path.rsplit("/", 1)[1], "project")
+def each(items, fn):
+    errors = []
+    for name in items:
+        try:
+            fn(name)
+        except SsError as e:
+            errors.append(str(e))
+        except OSError:
+            errors.append("{} not found".format(name))
+    if errors:
+        raise SsError("\n".join(errors))
+def add_tree(db, parent, local, text):
+    key, item = new_item(db, parent, os.path.basename(local), "project")
+    for name in sorted(os.listdir(local)):
+        path = os.path.join(local, name)
+        if os.path.isdir(path):
+            add_tree(db, item["path"], path, text)
+        else:
+            fkey, fitem = new_item(db, item["path"], name, "file")
+            with open(path, "rb") as f:
+                store(fitem, f.read(), text)
+def cmd_add(db, items, opts):
+    def add(name):
+        local = os.path.join(os.getcwd(), name)
+        if os.path.isdir(local):
+            if "-R" not in opts:
+                raise SsError("{} is a folder, use -R to add it".format(name))
+            add_tree(db, cur_proj(db), local, comment(opts))
+            return
+        data = local_read(name)
+        key, item = new_item(db, cur_proj(db), os.path.basename(name), "file")
+        store(item, data, comment(opts))
+    each(items, add)
+def cmd_checkout(db, items, opts):
+    def checkout(name):
+        key, item = lookup(db, name, "file")
+        if item.get("checkout"):
+            raise SsError("You currently have file {} checked out".format(name))
+        item["checkout"] = os.environ.get("SSUSER", "")
+        if "-G-" not in opts:
+            fetch(item, os.path.basename(name))
+    each(items, checkout)
+def cmd_checkin(db, items, opts):
+    def checkin(name):
+        key, item = lookup(db, name, "file")
+        if not item.get("checkout"):
+            raise SsError("You do not have {} checked out".format(name))
+        store(item, local_read(os.path.basename(name)), comment(opts))
+        item["checkout"] = None
+    each(items, checkin)
+def cmd_undocheckout(db, items, opts):
+    for name in items:
+        key, item = lookup(db, name)
+        for k in [key] + descendants(db, key):
+            db["items"][k]["checkout"] = None
+def cmd_get(db, items, opts):
+    def get(name):
+        key, item = lookup(db, name, "file")
+        fetch(item, os.path.basename(name))
+    each(items, get)
+def cmd_rename(db, items, opts):
+    key, path = resolve(db, items[0])
+    if key not in db["items"] or db["items"][key]["deleted"]:
+        raise SsError("{} does not exist".format(path))
+    item = db["items"][key]
+    name = items[1].rstrip("/").rsplit("/", 1)[-1]
+    new_key = parent_of(key) + "/" + name.lower()
+    if new_key in db["items"] and (new_key != key or item["path"].rsplit("/", 1)[1] == name):
+        raise SsError("An item with that name already exists")
+    move_item(db, key, parent_of(key), name)
+def move_item(db, key, new_parent, name):
+    old_path = db["items"][key]["path"]
+    new_key = new_parent + "/" + name.lower()
+    new_path = db["items"][new_parent]["path"] + "/" + name
+    for k in [key] + descendants(db, key):
+        item = db["items"].pop(k)
+        item["path"] = new_path + item["path"][len(old_path):]
+        db["items"][new_key + k[len(key):]] = item
+    for sess, proj in db["cwd"].items():
+        if proj.lower() == key or proj.lower().startswith(key + "/"):
+            db["cwd"][sess] = new_path + proj[len(old_path):]
+def cmd_move(db, items, opts):
+    key, item = lookup_proj(db, items[0])
+    target, titem = lookup_proj(db, items[1])
+    name = item["path"].rsplit("/", 1)[1]
+    if target + "/" + name.lower() in db["items"]:
+        raise SsError("{} already exists".format(name))
+    move_item(db, key, target, name)
+def cmd_delete(db, items, opts):
+    def delete(name):
+        key, item = lookup(db, name)
+        for k in [key] + descendants(db, key):
+            db["items"][k]["deleted"] = True
+    each(items, delete)
+def cmd_share(db, items, opts):
+    def share(name):
+        key, item = lookup(db, name, "file")
+        nkey, nitem = new_item(db, cur_proj(db), item["path"].rsplit("/", 1)[1], "file")
+        for k in ("hash", "versions", "content"):
+            nitem[k] = item.get(k)
+    each(items, share)
+def cmd_branch(db, items, opts):
+    for name in items:
+        lookup(db, name, "file")
+def cmd_dir(db, items, opts):
+    key, item = lookup_proj(db, items[0] if items else cur_proj(db))
+    projs = [key]
+    count = 0
+    out = []
+    while projs:
+        proj = projs.pop(0)
+        kids = children(db, proj)
+        if not kids and proj == key:
+            print ("No items found under " + db["items"][proj]["path"])
+            return
+        out.append(db["items"][proj]["path"] + ":")
+        subs = [(k, v) for k, v in kids if v["type"] == "project"]
+        files = [(k, v) for k, v in kids if v["type"] == "file"]
+        for k, v in subs:
+            out.append("$" + v["path"].rsplit("/", 1)[1])
+        for k, v in files:
+            out.append(v["path"].rsplit("/", 1)[1])
+        out.append("")
+        count += len(kids)
+        if "-R" in opts:
+            projs[0:0] = [k for k, v in subs]
+    out.append("{} item(s)".format(count))
+    print ("\n".join(out))
+commands = {
+    "cd": cmd_cd, "cp": cmd_cd, "project": cmd_project, "create": cmd_create,
+    "add": cmd_add, "checkout": cmd_checkout, "checkin": cmd_checkin,
+    "undocheckout": cmd_undocheckout, "get": cmd_get, "rename": cmd_rename,
+    "move": cmd_move, "delete": cmd_delete, "share": cmd_share,
+    "branch": cmd_branch, "dir": cmd_dir,
+}
+###############################################################################
+# main                                                                        #
+###############################################################################
+def main(argv):
+    command = argv[1].lower() if len(argv) > 1 else ""
+    items = [a for a in argv[2:] if not a.startswith("-")]
+    opts = [a for a in argv[2:] if a.startswith("-")]
+    if command not in commands:
+        print ("Unknown command " + command)
+        return err_vss
+    with open(os.path.join(db_dir(), calls_file), "a", encoding="utf8") as f:
+        f.write(" ".join(argv[1:]) + "\n")
+    corrupt = os.environ.get("SS_CORRUPT")
+    if corrupt and corrupt in " ".join(argv[1:]):
+        print ("File {} is corrupt, run analyze".format(os.path.join(db_dir(), "data", "corrupt")))
+        return err_vss
+    fail_at = os.environ.get("SS_FAIL_AT")
+    locked = int(os.environ.get("SS_LOCKED") or 0)
+    if fail_at is not None or locked > 0:
+        with open(os.path.join(db_dir(), calls_file), "r", encoding="utf8") as f:
+            calls = sum(1 for line in f)
+        if fail_at is not None and calls == int(fail_at):
+            print ("Network error: the database is not available")
+            return err_vss
+        if locked > 0 and calls % locked == 0:
+            print ("Access to file \"{}\" denied".format(os.path.join(db_dir(), "data", "lock")))
+            return err_vss
+    time.sleep(float(os.environ.get("SS_LATENCY", "0")))
+    with open(os.path.join(db_dir(), lock_file), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        db = db_load()
+        try:
+            commands[command](db, items, opts)
+        except SsError as e:
+            db_save(db)
+            print (str(e))
+            return err_vss
+        db_save(db)
+    return ok_vss
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
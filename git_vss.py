@@ -0,0 +1,2060 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+# The sync engine of sync-git-vss.py, to run syncs in-process.                #
+###############################################################################
+# Usage:                                                                      #
+#   import git_vss                                                            #
+#   engine = git_vss.SyncEngine(base_dir, git_url, git_branch, vss_proj,      #
+#                               vss_user, vss_pwd, opts={"batch": True})      #
+#   engine.run()                                                              #
+#                                                                             #
+# opts are the options of sync-git-vss.py by name, without the leading --:    #
+# flags are on when True or "" and off when False or None, values may be      #
+# given as strings or numbers. Unknown options, and values of number          #
+# options that are not whole numbers, raise SyncError.                        #
+# An engine keeps its configuration across runs and starts each run afresh;   #
+# run() syncs to the head of the branch and may be called again later. A      #
+# run changes the working folder of the process while it lasts, so run one    #
+# engine at a time per process. Failed syncs raise SyncError.                 #
+###############################################################################
+
+###############################################################################
+# imports                                                                     #
+###############################################################################
+import os
+import re
+import tempfile
+import shutil
+import subprocess
+import shlex
+import time
+import collections
+import itertools
+import threading
+import queue
+import json
+import math
+import random
+###############################################################################
+# git change set---status, path, old path (renames only), blobs after/before  #
+###############################################################################
+Change = collections.namedtuple("Change", "status path old_path blob old_blob")
+change_added    = "A"
+change_modified = "M"
+change_deleted  = "D"
+change_renamed  = "R"
+git_empty_tree  = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+git_mode_link   = "160000" # submodule, nothing to sync
+###############################################################################
+# sync plan---operations on vss, in the order they are applied                #
+###############################################################################
+Op = collections.namedtuple("Op", "kind subproj names changes")
+op_move        = "move"        # subproj moved or renamed to names[0]
+op_rename      = "rename"      # file of changes[0] renamed or moved
+op_delete_tree = "delete tree" # subproj gone from git, with all it holds
+op_delete_file = "delete file" # file names[0] of subproj, in the way of a new subproject
+op_import      = "import"      # top-level folders names added recursively
+op_create      = "create"      # subproj created along with missing parents
+op_add         = "add"         # names added to subproj
+op_checkin     = "checkin"     # names checked out and in again in subproj
+op_delete      = "delete"      # names deleted from subproj
+ops_global     = (op_move, op_rename, op_delete_tree, op_delete_file, op_import) # span subprojects
+vss_readonly   = ("ss dir", "ss get", "ss project") # what a dry run does issue
+###############################################################################
+# windows-specific shell command templates                                    #
+###############################################################################
+cmd_win_dir_files = 'dir /A:-D /B'
+cmd_win_dir_dirs  = 'dir /A:D /B'
+cmd_win_del_dir   = 'rm -rf "{}"'
+cmd_win_git_hash  = 'echo {} >"{}"'
+cmd_win_del_file  = 'rm -f "{}"'
+###############################################################################
+# git command templates                                                       #
+###############################################################################
+cmd_git_clone = 'git clone --no-checkout --single-branch --branch {}{} {} {}'
+cmd_git_ckout = 'git checkout {}'
+cmd_git_fetch = 'git fetch origin +refs/heads/{0}:refs/remotes/origin/{0}'
+cmd_git_deepen = 'git fetch --deepen={0} origin +refs/heads/{1}:refs/remotes/origin/{1}'
+cmd_git_shallow = 'git rev-parse --is-shallow-repository'
+cmd_git_history = 'git --no-pager rev-list HEAD'
+cmd_git_changed = 'git --no-pager diff -z --name-only --no-renames --diff-filter=ACMRT {} {}'
+cmd_git_names = 'git --no-pager ls-tree -z --name-only --full-tree HEAD "{}"'
+cmd_git_files = 'git --no-pager ls-tree -r -z --full-tree {}'
+cmd_git_sparse = 'git config core.sparseCheckout {}'
+cmd_git_sparse_cone = 'git config core.sparseCheckoutCone false'
+cmd_git_sparse_apply = 'git sparse-checkout reapply'
+cmd_git_sparse_off = 'git sparse-checkout disable'
+cmd_git_tag   = 'git tag {}'
+cmd_git_push  = 'git push --tags origin'
+cmd_git_hash  = 'git --no-pager log --format=format:%H -1'
+cmd_git_diff  = 'git --no-pager diff -z --raw --no-abbrev {} --diff-filter={} {} {}'
+cmd_git_dirs  = 'git --no-pager ls-tree -r -d -z --name-only --full-tree HEAD'
+cmd_git_revs  = 'git --no-pager rev-list --first-parent --reverse {}'
+cmd_git_commits = 'git --no-pager log --first-parent -m --reverse --name-only "--format=format:%x00%H %ct" {}'
+cmd_git_message = 'git --no-pager log --first-parent --reverse "--format=format:%h %an%n%B" {}'
+cmd_git_status = 'git status --porcelain -z --ignored --untracked-files=all'
+###############################################################################
+# vss command templates                                                       #
+###############################################################################
+cmd_vss_cd        = 'ss cd "{}"'
+cmd_vss_create    = 'ss create "{}" -I-'
+cmd_vss_add       = 'ss add "{}" -I-'
+cmd_vss_cp        = 'ss cp "{}"'
+cmd_vss_dir       = 'ss dir'
+cmd_vss_dir_tree  = 'ss dir "{}" -R'
+cmd_vss_get       = 'ss get "{}"'
+cmd_vss_del       = 'ss delete "{}" -I-Y'
+cmd_vss_ckin      = 'ss checkin "{}" -I-'
+cmd_vss_ckout     = 'ss checkout "{}" -G- -I-'
+cmd_vss_undockout = 'ss undocheckout "{}" -R -G- -I-Y'
+cmd_vss_rename    = 'ss rename "{}" "{}"'
+cmd_vss_move      = 'ss move "{}" "{}" -I-'
+cmd_vss_share     = 'ss share "{}" -I-'
+cmd_vss_branch    = 'ss branch "{}" -I-'
+cmd_vss_proj      = 'ss project'
+cmd_vss_git_ckout = 'ss checkout "{}"'
+cmd_vss_git_ckin  = 'ss checkin "{}" -I-'
+###############################################################################
+# vss multi-file command templates---{} is a list of quoted file names        #
+###############################################################################
+cmd_vss_add_files   = 'ss add {} -I-'
+cmd_vss_add_tree    = 'ss add {} -R -I-'
+cmd_vss_ckout_files = 'ss checkout {} -G- -I-'
+cmd_vss_ckin_files  = 'ss checkin {} -I-'
+cmd_vss_del_files   = 'ss delete {} -I-Y'
+###############################################################################
+# vss error return codes                                                      #
+###############################################################################
+err_vss = 100
+ok_vss  = 0
+pathlen_vss = 259
+cmdlen_vss  = 8000 # stay below cmd.exe's 8191-character command line limit
+###############################################################################
+# timestamp size for rename                                                   #
+###############################################################################
+ts_size = 10
+gitcommit_file = ".gitcommit"
+journal_file   = os.path.join(".git", "vss-sync.journal")
+manifest_file  = os.path.join(".git", "vss-manifest")
+comment_file   = os.path.join(".git", "vss-comment.txt")
+vss_encoding = "cp860"
+git_encoding = "utf8"
+cmd_encoding = "65001"
+###############################################################################
+# replay---vss comment of the commits being synced                            #
+###############################################################################
+vss_commented = ("ss add", "ss checkin", "ss create", "ss share", "ss branch")
+###############################################################################
+# streaming pipeline---changes flow from git to vss as git lists them         #
+###############################################################################
+stream_chunk = 65536 # bytes read from git at a time
+stream_queue = 1000  # changes listed ahead of vss, and changes per partition
+local_names_max = 64 # folders kept in local_names_cache
+###############################################################################
+# retries---ss failures that another attempt may not hit                      #
+###############################################################################
+vss_transient_errors = (r"\b(is|been) locked\b", r"\bin use\b", r"\bbeing used by another\b", r"\bsharing violation\b",
+                        r"\baccess to file\s+denied\b", r"\bnetwork (error|path|name)\b", r"\bnot available\b",
+                        r"\btimed out\b") # on the lower-case message without item names
+vss_expected_errors = ("does not exist", "already exists", "not an existing", "has been deleted", "you currently have",
+                       "no items found") # handled by the callers, never retried
+retry_base = 1.0  # seconds before the first retry of a command, doubled for each next one
+retry_max  = 60.0 # seconds between two attempts at most
+contention_max   = 4
+contention_calm  = 100 # successful ss calls that lower contention again
+###############################################################################
+# command trace---one entry per ss/git command                                #
+###############################################################################
+trace_slowest = 10 # subprojects listed in the summary
+###############################################################################
+# options---of sync-git-vss.py by name                                        #
+###############################################################################
+opts_flags   = ("batch", "no-renames", "replay", "dry-run", "sparse", "rebuild-manifest")
+opts_numbers = ("rename-threshold", "checkpoint", "replay-window", "replay-files", "jobs", "retries", "depth")
+opts_values  = ("trace", "metrics", "changes-cache", "filter")
+###############################################################################
+# helper functions---commands                                                 #
+###############################################################################
+def cmd_kind(cmd):
+    words = cmd.split() if isinstance(cmd, str) else cmd
+    return " ".join([word for word in words if not word.startswith("-")][:2]) # e.g. ss add, git diff
+def split_fields(f):
+    # NUL-terminated fields of a binary stream, as they are read
+    rest = b""
+    for chunk in iter(lambda: f.read1(stream_chunk), b""):
+        fields = (rest + chunk).split(b"\0")
+        rest = fields.pop()
+        for field in fields:
+            yield field
+    if rest != b"":
+        yield rest
+def percentile(times, p):
+    # nearest rank, times sorted
+    return times[max(0, int(math.ceil(p / 100.0 * len(times))) - 1)]
+def metric_label(value):
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+###############################################################################
+# helper functions---fatal error                                              #
+###############################################################################
+class SyncError(Exception):
+    pass
+def warn(msg, subproj):
+    print ("Warning on " + subproj + ": " + msg)
+###############################################################################
+# helper functions---retries                                                  #
+###############################################################################
+def vss_message(out, cmd):
+    # the message of a failed ss command without the names of the items, which
+    # could read like anything (e.g. $/NetworkTools)
+    err = out.decode(vss_encoding, errors="replace").lower()
+    err = re.sub(r'\s*"[^"]*"', "", err) # quoted names and paths
+    names = re.findall(r'"([^"]*)"', cmd) if isinstance(cmd, str) else cmd[2:]
+    for name in sorted(set(names) | set(os.path.basename(name) for name in names), key=len, reverse=True):
+        if name != "":
+            err = err.replace(name.lower(), "")
+    return re.sub(r"\$\S*", "$", err) # other project paths
+def vss_transient(out, cmd):
+    # locks, sharing violations and network errors come from other users of
+    # the database, anything else would fail again
+    err = vss_message(out, cmd)
+    if any(expected in err for expected in vss_expected_errors):
+        return False
+    return any(re.search(pattern, err) for pattern in vss_transient_errors)
+def retry_delay(attempt):
+    # exponential backoff with jitter, so that contending clients do not
+    # retry in step
+    delay = min(retry_max, retry_base * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+###############################################################################
+# helper functions---vss                                                      #
+###############################################################################
+def vss_get_error(e):
+    return e.output.decode(vss_encoding).strip()
+###############################################################################
+# helper functions---vss snapshot                                             #
+###############################################################################
+def subproj_join(subproj, name):
+    if subproj == "":
+        return name
+    return subproj + "/" + name
+###############################################################################
+# helper functions---git                                                      #
+###############################################################################
+def sparse_pattern(path):
+    for c in "\\*?[!# ":
+        path = path.replace(c, "\\" + c)
+    return "/" + path
+###############################################################################
+# helper functions---renames                                                  #
+###############################################################################
+def rename_roots(change):
+    # (old, new) subproject pairs, shallowest first, such that moving old to
+    # new turns change.old_path into change.path
+    old = change.old_path.split("/")
+    new = change.path.split("/")
+    roots = []
+    while len(old) > 1 and len(new) > 1 and old[-1] == new[-1]:
+        old = old[:-1]
+        new = new[:-1]
+        if "/".join(old).lower() != "/".join(new).lower(): # case-only, vss_cd_create follows it
+            roots.insert(0, ("/".join(old), "/".join(new)))
+    return roots
+###############################################################################
+# helper functions---deleted subprojects                                      #
+###############################################################################
+def deleted_root(path, dirs):
+    # top-most directory of path that is gone from git, if any
+    parts = path.split("/")[:-1]
+    for n in range(1, len(parts) + 1):
+        root = "/".join(parts[:n])
+        if root.lower() not in dirs:
+            return root
+    return None
+###############################################################################
+# helper functions---batched sync                                             #
+###############################################################################
+def quote_files(files):
+    return " ".join('"{}"'.format(filename) for filename in files)
+def vss_per_file_cost(count, exists, deleted):
+    # calls of the per-file sync for count files of a subproject: cd, then
+    # checkout, rename and delete, or add, or checkout and checkin per file
+    return 1 + count * (3 if deleted else 2 if exists else 1)
+def group_changes(changes):
+    # git lists a folder's subtree in one run, so the group of a folder is
+    # complete once the changes leave its subtree; only the groups of the
+    # folders above the current change are open
+    groups = [] # (lower-case subproject, subproject, changes), parents first
+    for change in changes:
+        subproj = os.path.dirname(change.path)
+        key = subproj.lower()
+        while len(groups) > 0 and groups[-1][0] != key and not key.startswith(groups[-1][0] + "/") and groups[-1][0] != "":
+            yield groups.pop()[1:]
+        if len(groups) == 0 or groups[-1][0] != key:
+            groups.append((key, subproj, []))
+        elif change.status != change_deleted and groups[-1][1] != subproj:
+            # spelled as in git, not as a deleted file of another case
+            groups[-1] = (key, subproj, groups[-1][2])
+        groups[-1][2].append(change)
+    while len(groups) > 0:
+        yield groups.pop()[1:]
+###############################################################################
+# helper functions---options                                                  #
+###############################################################################
+def engine_opts(opts):
+    # opts as the command line gives them: name -> string, "" for flags; a
+    # misspelt option must not go unnoticed, e.g. a dry run would change vss
+    result = dict()
+    for name, value in (opts or dict()).items():
+        if name not in opts_flags + opts_numbers + opts_values:
+            raise SyncError("unknown option --" + name)
+        if value is None or value is False: # off
+            continue
+        result[name] = "" if value is True else str(value)
+        if name in opts_numbers and not result[name].isdigit():
+            raise SyncError("option --" + name + " expects a whole number, not '" + result[name] + "'")
+    return result
+###############################################################################
+# sync engine---one git branch -> vss project mapping                         #
+###############################################################################
+class SyncEngine:
+    def __init__(self, base_dir, git_repo, git_branch, vss_proj, vss_user, vss_passwd, git_tag=None, opts=None, sspath=None, env=None):
+        # opts as parsed from the command line or typed (see engine_opts),
+        # sspath defaults to %SSPATH% and env, the environment of the commands,
+        # to that of the process
+        opts = engine_opts(opts)
+        self.base_dir    = os.path.abspath(base_dir) # runs change folders
+        self.git_repo    = git_repo
+        self.git_branch  = git_branch
+        self.vss_proj    = vss_proj
+        self.vss_user    = vss_user
+        self.vss_passwd  = vss_passwd
+        self.git_tag     = git_tag # None for no tag
+        self.use_batch   = "batch" in opts
+        self.rename_opt  = "-M" + opts.get("rename-threshold", "50") + "%"
+        if "no-renames" in opts:
+            self.rename_opt = "--no-renames"
+        self.checkpoint  = int(opts.get("checkpoint") or 0)
+        self.use_replay  = "replay" in opts
+        self.replay_window = int(opts.get("replay-window") or 0)
+        self.replay_files  = int(opts.get("replay-files") or 0)
+        self.jobs        = int(opts.get("jobs") or 1)
+        self.retries     = int(opts.get("retries") or 50)
+        self.dry_run     = "dry-run" in opts
+        self.trace_file  = os.path.abspath(opts.get("trace") or os.path.join(self.base_dir, ".git", "vss-sync-trace.json")) # runs change folders
+        self.metrics_file = os.path.abspath(opts.get("metrics") or os.path.join(self.base_dir, ".git", "vss-sync.prom"))
+        self.changes_cache = os.path.abspath(opts["changes-cache"]) if opts.get("changes-cache") else None
+        self.depth       = int(opts.get("depth") or 0)
+        self.use_sparse  = "sparse" in opts
+        self.rebuild_manifest = "rebuild-manifest" in opts
+        self.clone_opts  = ""
+        if self.depth > 0:
+            self.clone_opts = self.clone_opts + " --depth " + str(self.depth)
+        if opts.get("filter"):
+            self.clone_opts = self.clone_opts + " --filter=" + opts["filter"]
+        # vss-specific environment variables, for this engine's commands only
+        self.env = dict(os.environ if env is None else env)
+        sspath = sspath or self.env.get("SSPATH")
+        if sspath is None:
+            raise SyncError("SSPATH is not set, it should point to the VSS database")
+        self.env["SSDIR"]  = sspath
+        self.env["SSUSER"] = vss_user
+        self.env["SSPWD"]  = vss_passwd
+        self.reset()
+    def reset(self):
+        # state of a run
+        # git snapshot
+        self.git_snap_files   = dict()
+        self.git_snap_subdirs = dict()
+        self.git_head_dirs    = None # lower-case directories at HEAD, see git_dir_exists
+        # sync plan
+        self.plan_calls = collections.Counter() # ss calls a dry run would have issued, per kind
+        # vss snapshot---lower-case subproject -> {lower-case name: vss name}
+        self.vss_snap_files   = dict()
+        self.vss_snap_subdirs = dict()
+        self.vss_git_hash_out = False # .gitcommit checked out by us
+        # sync statistics
+        self.vss_calls          = 0 # ss invocations issued so far
+        self.vss_calls_per_file = 0 # ss invocations the per-file sync would have issued
+        self.vss_calls_batched  = 0 # ss invocations of the batched operations, to compare with it
+        # sync journal---changes done towards the target commit
+        self.journal        = None
+        self.journal_target = None
+        self.journal_done   = set()
+        # manifest---lower-case path -> git blob last pushed to vss
+        self.manifest         = dict()
+        self.manifest_out     = None # manifest file, files pushed are appended to it
+        self.manifest_skipped = 0    # files skipped by this sync, vss had them already
+        # replay---vss comment of the commits being synced
+        self.vss_comment = "" # -C option of the commands in vss_commented, empty for no comment
+        # streaming pipeline
+        self.local_names_cache = collections.OrderedDict() # checkout folder -> {lower-case name: names}
+        self.listing_threads = []                # threads listing changes from git
+        self.listing_cancel  = threading.Event() # set once the run is over, they stop listing
+        # retries
+        self.retries_left     = self.retries
+        self.contention       = 0 # raised by every transient failure, halves workers and command lines
+        self.contention_calls = 0
+        # command trace---one entry per ss/git command
+        self.trace       = []
+        self.trace_start = time.perf_counter()
+        self.trace_wall  = time.time()
+        # parallel workers---per-thread working folder and ss environment
+        self.main_thread = threading.current_thread() # the one running the sync
+        self.worker    = threading.local()
+        self.workers_running = False # errors of the main thread are reported once they stop
+        self.sync_lock = threading.RLock() # guards statistics, snapshot and journal
+        self.sync_done   = 0     # changes processed, for progress across workers
+        self.sync_total  = 0     # changes listed so far
+        self.sync_listed = False # whether git has listed every change
+        self.sync_start  = 0.0
+    ###########################################################################
+    # helper functions---commands                                             #
+    ###########################################################################
+    def run_cmd(self, cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, subproj=""):
+        # every ss and git command goes through here to be traced
+        if isinstance(cmd, str) and os.name != "nt":
+            cmd = shlex.split(cmd) # only Windows passes a command line through as-is
+        start = time.perf_counter()
+        proc = subprocess.run(cmd, stdout=stdout, stderr=stderr, cwd=getattr(self.worker, "cwd", None), env=getattr(self.worker, "env", self.env))
+        self.trace_add(cmd, subproj, start, proc.returncode)
+        return proc
+    def run_stream(self, cmd, subproj=""):
+        # like run_cmd, but yields the NUL-terminated fields of the output as the
+        # command writes them; raises CalledProcessError once they are all read
+        # if the command failed, as they may be cut off
+        if isinstance(cmd, str) and os.name != "nt":
+            cmd = shlex.split(cmd)
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=getattr(self.worker, "cwd", None), env=getattr(self.worker, "env", self.env))
+        try:
+            yield from split_fields(proc.stdout)
+        finally:
+            proc.stdout.close() # stops the command if we stopped reading
+            proc.wait()
+            self.trace_add(cmd, subproj, start, proc.returncode)
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+    def trace_add(self, cmd, subproj, start, returncode):
+        entry = {
+            "kind": cmd_kind(cmd),
+            "subproj": subproj,
+            "start": round(start - self.trace_start, 3),
+            "time": round(time.perf_counter() - start, 3),
+            "exit": returncode,
+            "expected": False,
+            "retried": False,
+            "worker": threading.current_thread().name,
+        }
+        with self.sync_lock:
+            self.trace.append(entry)
+        self.worker.last = entry
+    def trace_expected(self):
+        # the last command of this thread failed the way its caller expected
+        entry = getattr(self.worker, "last", None)
+        if entry is not None and entry["exit"] != 0:
+            entry["expected"] = True
+    def trace_summary(self):
+        kinds = dict()
+        subprojs = dict()
+        for entry in self.trace:
+            kinds.setdefault(entry["kind"], []).append(entry)
+            if entry["kind"].startswith("ss"):
+                subprojs.setdefault(entry["subproj"].lower(), []).append(entry)
+        summary = {"kinds": dict(), "subprojects": []}
+        for kind in sorted(kinds):
+            times = sorted(entry["time"] for entry in kinds[kind])
+            summary["kinds"][kind] = {
+                "calls": len(times),
+                "time": round(sum(times), 3),
+                "expected_failures": len([entry for entry in kinds[kind] if entry["expected"]]),
+                "failures": len([entry for entry in kinds[kind] if entry["exit"] != 0 and not entry["expected"] and not entry["retried"]]),
+                "retries": len([entry for entry in kinds[kind] if entry["retried"]]),
+                "p50": percentile(times, 50),
+                "p90": percentile(times, 90),
+                "p99": percentile(times, 99),
+            }
+        for key in sorted(subprojs, key=lambda key: sum(entry["time"] for entry in subprojs[key]), reverse=True)[:trace_slowest]:
+            entries = subprojs[key]
+            summary["subprojects"].append({
+                "subproj": self.vss_path(entries[0]["subproj"]),
+                "calls": len(entries),
+                "time": round(sum(entry["time"] for entry in entries), 3),
+            })
+        return summary
+    def trace_write(self, result):
+        if self.dry_run: # keep the timings of the last real run for estimates
+            return
+        duration = round(time.perf_counter() - self.trace_start, 3)
+        summary = self.trace_summary()
+        print ("Command summary (" + result + ", " + str(duration) + "s):")
+        for kind, stats in summary["kinds"].items():
+            print ("  {:<16} {:>6} calls {:>9.3f}s  p50 {:.3f}s  p90 {:.3f}s  p99 {:.3f}s  {} expected failures  {} retries".format(
+                kind, stats["calls"], stats["time"], stats["p50"], stats["p90"], stats["p99"], stats["expected_failures"], stats["retries"]))
+        print ("Slowest subprojects:")
+        for stats in summary["subprojects"]:
+            print ("  {:>9.3f}s {:>6} calls  {}".format(stats["time"], stats["calls"], stats["subproj"]))
+        project = "project=" + metric_label(self.vss_proj)
+        metrics = [
+            "# HELP git_vss_sync_success Whether the last sync succeeded.",
+            "# TYPE git_vss_sync_success gauge",
+            "git_vss_sync_success{" + project + "} " + ("1" if result == "ok" else "0"),
+            "# HELP git_vss_sync_duration_seconds Wall time of the last sync.",
+            "# TYPE git_vss_sync_duration_seconds gauge",
+            "git_vss_sync_duration_seconds{" + project + "} " + str(duration),
+            "# HELP git_vss_sync_timestamp_seconds When the last sync finished.",
+            "# TYPE git_vss_sync_timestamp_seconds gauge",
+            "git_vss_sync_timestamp_seconds{" + project + "} " + str(round(time.time())),
+            "# HELP git_vss_command_calls Commands run by the last sync.",
+            "# TYPE git_vss_command_calls gauge",
+            "# HELP git_vss_command_seconds Time spent in commands by the last sync.",
+            "# TYPE git_vss_command_seconds gauge",
+            "# HELP git_vss_command_failures Failed commands of the last sync.",
+            "# TYPE git_vss_command_failures gauge",
+            "# HELP git_vss_command_retries Commands of the last sync that failed and were run again.",
+            "# TYPE git_vss_command_retries gauge",
+            "# HELP git_vss_command_quantile_seconds Command duration quantiles of the last sync.",
+            "# TYPE git_vss_command_quantile_seconds gauge",
+        ]
+        for kind, stats in summary["kinds"].items():
+            labels = project + ",kind=" + metric_label(kind)
+            metrics.append("git_vss_command_calls{" + labels + "} " + str(stats["calls"]))
+            metrics.append("git_vss_command_seconds{" + labels + "} " + str(stats["time"]))
+            metrics.append("git_vss_command_failures{" + labels + ',expected="true"} ' + str(stats["expected_failures"]))
+            metrics.append("git_vss_command_failures{" + labels + ',expected="false"} ' + str(stats["failures"]))
+            metrics.append("git_vss_command_retries{" + labels + "} " + str(stats["retries"]))
+            for q in (50, 90, 99):
+                metrics.append("git_vss_command_quantile_seconds{" + labels + ',quantile="0.' + str(q) + '"} ' + str(stats["p" + str(q)]))
+        try:
+            with open(self.trace_file, "w", encoding="utf8") as f:
+                json.dump({
+                    "project": self.vss_proj,
+                    "branch": self.git_branch,
+                    "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.trace_wall)),
+                    "duration": duration,
+                    "result": result,
+                    "summary": summary,
+                    "commands": self.trace,
+                }, f, indent=1)
+            with open(self.metrics_file + ".tmp", "w", encoding="utf8") as f: # textfile collectors must not see partial files
+                f.write("\n".join(metrics) + "\n")
+            os.replace(self.metrics_file + ".tmp", self.metrics_file)
+        except OSError as e:
+            warn("could not write trace: " + str(e), self.vss_proj)
+    ###########################################################################
+    # helper functions---fatal error                                          #
+    ###########################################################################
+    def fatal_error(self, msg, subproj, filename):
+        self.fatal_stop("Error on " + subproj + "/" + filename + ": " + msg)
+    def fatal_stop(self, err):
+        if threading.current_thread() is not self.main_thread or self.workers_running: # reported later
+            raise SyncError(err)
+        self.run_cmd(cmd_vss_proj, stdout=None, stderr=None)
+        print (os.getcwd())
+        if not self.dry_run:
+            self.run_cmd(cmd_vss_undockout.format(self.vss_proj), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        os.chdir(self.base_dir)
+        try:
+            os.remove(gitcommit_file)
+        except FileNotFoundError:
+            pass # whatever
+        print (err)
+        self.trace_write("failed")
+        raise SyncError(err)
+    def fatal_raise(self, e):
+        # an error handed over by another thread, reported as if it were ours
+        if isinstance(e, SyncError):
+            self.fatal_stop(str(e))
+        raise e
+    ###########################################################################
+    # helper functions---path length                                          #
+    ###########################################################################
+    def trunc_filename(self, subproj, filename):
+        path = subproj + "/" + filename
+        trunc = len(path) + ts_size - pathlen_vss
+        index = len(filename) - trunc
+        if index < 0:
+            self.fatal_error("Cannot rename without violating VSS path length restrictions.", subproj, filename)
+        else:
+            return filename[:index]
+    ###########################################################################
+    # helper functions---retries                                              #
+    ###########################################################################
+    def contention_rise(self):
+        # take a retry from the budget of the run, False if none is left
+        with self.sync_lock:
+            if self.retries_left <= 0:
+                return False
+            self.retries_left = self.retries_left - 1
+            self.contention = min(self.contention + 1, contention_max)
+            self.contention_calls = 0
+            return True
+    def contention_ease(self):
+        with self.sync_lock:
+            if self.contention == 0:
+                return
+            self.contention_calls = self.contention_calls + 1
+            if self.contention_calls >= contention_calm:
+                self.contention = self.contention - 1
+                self.contention_calls = 0
+    def jobs_allowed(self):
+        return max(1, self.jobs >> self.contention)
+    def cmdlen_allowed(self):
+        return cmdlen_vss >> self.contention
+    ###########################################################################
+    # helper functions---vss                                                  #
+    ###########################################################################
+    def vss_get_proj(self):
+        out = self.run_cmd(cmd_vss_proj.split(), stderr=None).stdout
+        proj = out.decode(git_encoding).strip()[19:].replace("\r", "").replace("\n", "")
+        return proj
+    def vss_call(self, cmd, subproj):
+        # transient failures are retried while the run has retries left, others
+        # are raised for the caller to handle; subproj is the one cmd works on,
+        # for the trace
+        if self.vss_comment != "" and isinstance(cmd, str) and cmd_kind(cmd) in vss_commented:
+            cmd = cmd + self.vss_comment
+        if self.dry_run and cmd_kind(cmd) not in vss_readonly: # counted as if it succeeded
+            with self.sync_lock:
+                self.plan_calls[cmd_kind(cmd)] = self.plan_calls[cmd_kind(cmd)] + 1
+            return b""
+        attempt = 0
+        while True:
+            with self.sync_lock:
+                self.vss_calls = self.vss_calls + 1
+            self.worker.calls = getattr(self.worker, "calls", 0) + 1 # of this thread, see apply_op
+            proc = self.run_cmd(cmd, subproj=subproj)
+            if proc.returncode == 0:
+                self.contention_ease()
+                return proc.stdout
+            if not vss_transient(proc.stdout, cmd) or not self.contention_rise():
+                raise subprocess.CalledProcessError(proc.returncode, cmd, output=proc.stdout)
+            self.worker.last["retried"] = True
+            delay = retry_delay(attempt)
+            err = proc.stdout.decode(vss_encoding, errors="replace").strip().split("\n")[0]
+            warn("{} (retrying in {:.1f}s, {} retries left)".format(err.strip(), delay, self.retries_left), self.vss_path(subproj))
+            time.sleep(delay)
+            attempt = attempt + 1
+    def local_cd(self, path):
+        # workers share the process, each keeps its own working folder
+        if threading.current_thread() is self.main_thread:
+            os.chdir(path)
+        else:
+            self.worker.cwd = path
+    def vss_cd_root(self):
+        try:
+            self.vss_call(cmd_vss_cd.format(self.vss_proj), "")
+            self.worker.vss_cwd = ""
+            os.chdir(self.base_dir)
+        except subprocess.CalledProcessError as e:
+            err = vss_get_error(e)
+            if "does not exist" in err:
+                self.trace_expected()
+                try:
+                    self.vss_call(cmd_vss_create.format(self.vss_proj), "")
+                    self.vss_call(cmd_vss_cd.format(self.vss_proj), "")
+                    self.worker.vss_cwd = ""
+                    os.chdir(self.base_dir)
+                except subprocess.CalledProcessError as e:
+                    err = vss_get_error(e)
+                    self.fatal_error(err, self.vss_proj, "")
+            else:
+                self.fatal_error(err, self.vss_proj, "")
+    def vss_path(self, subproj):
+        if subproj == "":
+            return self.vss_proj
+        return self.vss_proj + "/" + subproj
+    def vss_cd(self, subproj):
+        if getattr(self.worker, "vss_cwd", None) == subproj: # already there
+            return
+        self.vss_call(cmd_vss_cd.format(self.vss_path(subproj)), subproj)
+        self.worker.vss_cwd = subproj
+    def vss_cd_forget(self):
+        # subprojects were renamed, moved or deleted, the current one may be gone
+        self.worker.vss_cwd = None
+    def vss_git_hash_ckout(self):
+        try:
+            self.vss_call(cmd_vss_git_ckout.format(gitcommit_file), "")
+        except subprocess.CalledProcessError as e:
+            err = vss_get_error(e)
+            if "You currently have" not in err:
+                self.fatal_error(err, "", gitcommit_file)
+            self.trace_expected()
+        self.vss_git_hash_out = True
+    def vss_git_hash_set(self, commit):
+        if self.vss_snap_file("", gitcommit_file) is not None and not self.vss_git_hash_out:
+            self.vss_git_hash_ckout()
+        subprocess.call(cmd_win_git_hash.format(commit, gitcommit_file), shell=True)
+        try:
+            if self.vss_snap_file("", gitcommit_file) is None:
+                self.vss_call(cmd_vss_add.format(gitcommit_file), "")
+                self.vss_snap_add_file("", gitcommit_file)
+            else:
+                self.vss_call(cmd_vss_git_ckin.format(gitcommit_file), "")
+        except subprocess.CalledProcessError as e:
+            err = vss_get_error(e)
+            self.fatal_error(err, "", gitcommit_file)
+        self.vss_git_hash_out = False
+    def vss_git_hash_get(self):
+        if self.vss_snap_file("", gitcommit_file) is None: # no sync file
+            return None
+        if self.dry_run: # read it without checking it out
+            try:
+                self.vss_call(cmd_vss_get.format(self.vss_path(gitcommit_file)), "")
+            except subprocess.CalledProcessError as e:
+                self.fatal_error(vss_get_error(e), "", gitcommit_file)
+        else:
+            self.vss_git_hash_ckout()
+        p = subprocess.Popen(["cat", gitcommit_file], stdout=subprocess.PIPE)
+        out, err = p.communicate()
+        return out.decode(git_encoding).strip()
+    def vss_create_needed(self, subproj):
+        parent = ""
+        for dir in subproj.split("/") if subproj != "" else []:
+            path = subproj_join(parent, dir)
+            if self.vss_snap_subproj(path) != dir:
+                return True
+            parent = path
+        return False
+    def vss_create(self, subproj):
+        # create subproj and its missing parents, following case-only renames
+        parent = ""
+        for dir in subproj.split("/") if subproj != "" else []:
+            path = subproj_join(parent, dir)
+            vss_name = self.vss_snap_subproj(path)
+            try:
+                if vss_name is None: # subproject doesn't exist yet
+                    self.vss_call(cmd_vss_create.format(self.vss_path(path)), path)
+                elif vss_name != dir: # follow case-only renames
+                    self.vss_cd_forget()
+                    self.vss_call(cmd_vss_rename.format(self.vss_path(subproj_join(parent, vss_name)), self.vss_path(path)), path)
+            except subprocess.CalledProcessError as e:
+                err = vss_get_error(e)
+                if not err.endswith("already exists"):
+                    self.fatal_error(err, path, "")
+                self.trace_expected()
+            self.vss_snap_add_subproj(path)
+            parent = path
+    def vss_cd_create(self, subproj):
+        self.vss_create(subproj)
+        try: # change to subproject
+            self.vss_cd(subproj)
+        except subprocess.CalledProcessError as e:
+            err = vss_get_error(e)
+            self.fatal_error(err, subproj, "")
+        self.local_cd(os.path.join(self.base_dir, subproj))
+    def vss_add_or_modify(self, subproj, filename):
+        self.vss_cd_create(subproj)
+        vss_name = self.vss_snap_file(subproj, filename)
+        if vss_name is None:
+            try: # add
+                self.vss_call(cmd_vss_add.format(filename), subproj)
+                self.vss_snap_add_file(subproj, filename)
+                return
+            except subprocess.CalledProcessError as e:
+                err = vss_get_error(e)
+                if not err.endswith("already exists"): # file does not exist but add failed, something went wrong
+                    self.fatal_error(err, subproj, filename)
+                self.trace_expected()
+                vss_name = filename
+        try: # checkout
+            self.vss_call(cmd_vss_ckout.format(filename), subproj)
+        except subprocess.CalledProcessError as e:
+            err = vss_get_error(e)
+            if "You currently have" not in err: # unless we already have the file checked out, something went wrong
+                self.fatal_error(err, subproj, filename)
+            self.trace_expected()
+        try: # file checked out, checkin
+            self.vss_call(cmd_vss_ckin.format(filename), subproj)
+        except subprocess.CalledProcessError as e: # could not checkin, something went wrong
+            err = vss_get_error(e)
+            self.fatal_error(err, subproj, filename)
+        self.vss_rename_case(subproj, vss_name, filename)
+    def vss_rename_case(self, subproj, vss_name, filename):
+        if vss_name == filename:
+            return
+        try: # follow case-only renames
+            self.vss_call(cmd_vss_rename.format(vss_name, filename), subproj)
+        except subprocess.CalledProcessError as e:
+            err = vss_get_error(e)
+            if "that name already exists" not in err:
+                self.fatal_error(err, subproj, filename)
+            self.trace_expected()
+        self.vss_snap_add_file(subproj, filename)
+    def vss_destroy(self, subproj, vss_name):
+        # rename out of the way before deleting, vss keeps deleted item names
+        self.vss_cd_forget()
+        ts = str(time.time())[:ts_size]
+        new_name = self.trunc_filename(subproj, vss_name) + ts
+        renamed_path = self.vss_path(subproj_join(subproj, new_name))
+        target = subproj_join(subproj, vss_name)
+        if self.vss_snap_subproj(target) is None: # a file, credited to its subproject
+            target = subproj
+        self.vss_call(cmd_vss_rename.format(self.vss_path(subproj_join(subproj, vss_name)), renamed_path), target)
+        self.vss_call(cmd_vss_del.format(renamed_path), target)
+    def vss_delete_empty_subproj(self, subproj):
+        if subproj == "" or not self.vss_snap_empty(subproj):
+            return
+        # rename and delete subproject
+        path = os.path.dirname(subproj)
+        filename = self.vss_snap_subproj(subproj)
+        try:
+            self.vss_destroy(path, filename)
+        except subprocess.CalledProcessError as e: # could not rename, something went wrong
+            err = vss_get_error(e)
+            self.fatal_error(err, subproj, filename)
+        self.vss_snap_del_subproj(subproj)
+        self.vss_delete_empty_subproj(path)
+    def vss_delete(self, subproj, filename):
+        vss_name = self.vss_snap_file(subproj, filename)
+        if vss_name is None: # file doesn't exist, nothing to do
+            return
+        try: # change vss project
+            self.vss_cd(subproj)
+        except subprocess.CalledProcessError as e:
+            err = vss_get_error(e)
+            self.fatal_error(err, subproj, filename)
+        try: # checkout
+            self.vss_call(cmd_vss_ckout.format(vss_name), subproj)
+        except subprocess.CalledProcessError as e:
+            err = vss_get_error(e)
+            if "not an existing" in err or "has been deleted" in err: # file doesn't exist, nothing to do
+                self.trace_expected()
+                self.vss_snap_del_file(subproj, filename)
+                return
+            elif "You currently have" not in err: # unless we already have the file checked out, something went wrong
+                self.fatal_error(err, subproj, filename)
+            self.trace_expected()
+        try: # rename
+            ts = str(time.time())[:ts_size]
+            new_filename = self.trunc_filename(subproj, vss_name) + ts
+            self.vss_call(cmd_vss_rename.format(vss_name, new_filename), subproj)
+        except subprocess.CalledProcessError as e: # could not rename, something went wrong
+            err = vss_get_error(e)
+            self.fatal_error(err, subproj, filename)
+        try: # delete rename file
+            self.vss_call(cmd_vss_del.format(new_filename), subproj)
+        except subprocess.CalledProcessError as e:
+            err = vss_get_error(e)
+            if "has been deleted" not in err: # unless the file has already been deleted, something went wrong
+                self.fatal_error(err, subproj, filename)
+            self.trace_expected()
+        self.vss_snap_del_file(subproj, filename)
+        if not self.git_dir_exists(subproj):
+            self.vss_delete_empty_subproj(subproj)
+    ###########################################################################
+    # helper functions---vss snapshot                                         #
+    ###########################################################################
+    def vss_snap_load(self):
+        # parse the output of a recursive ss dir, one "$/project:" header per
+        # subproject followed by its "$subproject" and file entries
+        self.vss_snap_files.clear()
+        self.vss_snap_subdirs.clear()
+        self.vss_snap_add_subproj("")
+        try:
+            out = self.vss_call(cmd_vss_dir_tree.format(self.vss_proj), "").decode(vss_encoding)
+        except subprocess.CalledProcessError as e:
+            err = vss_get_error(e)
+            if self.dry_run and "does not exist" in err: # vss_cd_root did not create it, an empty project
+                self.vss_call(cmd_vss_create.format(self.vss_proj), "") # counted, issues nothing
+            elif not err.startswith("No items found"): # a partial snapshot would sync wrongly
+                self.fatal_error(err, self.vss_proj, "")
+            self.trace_expected()
+            out = ""
+        subproj = None
+        for line in out.splitlines():
+            line = line.strip()
+            if line.endswith(":") and line.lower().startswith(self.vss_proj.lower()):
+                subproj = line[len(self.vss_proj):-1].strip("/")
+                self.vss_snap_add_subproj(subproj)
+            elif subproj is None or line == "" or line.endswith("item(s)") or line.startswith("No items found"):
+                continue
+            elif line.startswith("$"):
+                self.vss_snap_add_subproj(subproj_join(subproj, line[1:]))
+            else:
+                self.vss_snap_add_file(subproj, line)
+    def vss_snap_subproj(self, subproj):
+        if subproj == "":
+            return "" if "" in self.vss_snap_subdirs else None
+        parent = self.vss_snap_subdirs.get(os.path.dirname(subproj).lower(), dict())
+        return parent.get(os.path.basename(subproj).lower()) # vss name
+    def vss_snap_file(self, subproj, filename):
+        return self.vss_snap_files.get(subproj.lower(), dict()).get(filename.lower()) # vss name
+    def vss_snap_empty(self, subproj):
+        key = subproj.lower()
+        return len(self.vss_snap_files.get(key, dict())) == 0 and len(self.vss_snap_subdirs.get(key, dict())) == 0
+    def vss_snap_add_subproj(self, subproj):
+        with self.sync_lock:
+            key = subproj.lower()
+            if key not in self.vss_snap_subdirs:
+                self.vss_snap_subdirs[key] = dict()
+                self.vss_snap_files[key] = dict()
+            if subproj != "":
+                parent = os.path.dirname(subproj)
+                self.vss_snap_add_subproj(parent)
+                self.vss_snap_subdirs[parent.lower()][os.path.basename(key)] = os.path.basename(subproj)
+    def vss_snap_del_subproj(self, subproj):
+        with self.sync_lock:
+            key = subproj.lower()
+            for k in [k for k in self.vss_snap_subdirs if k == key or k.startswith(key + "/")]:
+                del self.vss_snap_subdirs[k]
+                del self.vss_snap_files[k]
+            self.vss_snap_subdirs.get(os.path.dirname(key), dict()).pop(os.path.basename(key), None)
+    def vss_snap_move_subproj(self, subproj, new_subproj):
+        with self.sync_lock:
+            key = subproj.lower()
+            new_key = new_subproj.lower()
+            for k in [k for k in self.vss_snap_subdirs if k == key or k.startswith(key + "/")]:
+                self.vss_snap_subdirs[new_key + k[len(key):]] = self.vss_snap_subdirs.pop(k)
+                self.vss_snap_files[new_key + k[len(key):]] = self.vss_snap_files.pop(k)
+            self.vss_snap_subdirs.get(os.path.dirname(key), dict()).pop(os.path.basename(key), None)
+            self.vss_snap_add_subproj(new_subproj)
+    def vss_snap_tree_files(self, subproj):
+        # lower-case paths of all files in subproj and its subprojects
+        with self.sync_lock:
+            key = subproj.lower()
+            return set(subproj_join(k, name) for k in self.vss_snap_files if k == key or k.startswith(key + "/")
+                                              for name in self.vss_snap_files[k])
+    def vss_snap_add_file(self, subproj, filename):
+        with self.sync_lock:
+            self.vss_snap_add_subproj(subproj)
+            self.vss_snap_files[subproj.lower()][filename.lower()] = filename
+    def vss_snap_del_file(self, subproj, filename):
+        with self.sync_lock:
+            self.vss_snap_files.get(subproj.lower(), dict()).pop(filename.lower(), None)
+    ###########################################################################
+    # helper functions---git                                                  #
+    ###########################################################################
+    def git_output(self, cmd):
+        proc = self.run_cmd(cmd, stderr=None)
+        if proc.returncode != 0: # the output may be empty or cut off
+            self.git_failed(subprocess.CalledProcessError(proc.returncode, cmd))
+        return proc.stdout.decode(git_encoding)
+    def git_failed(self, e):
+        self.fatal_error(cmd_kind(e.cmd) + " exited with " + str(e.returncode), self.vss_proj, "")
+    def git_call(self, cmd, quiet=False, check=False):
+        # check for the commands the sync relies on, their failure is fatal
+        if quiet:
+            proc = self.run_cmd(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            proc = self.run_cmd(cmd, stdout=None, stderr=None)
+        if check and proc.returncode != 0:
+            self.git_failed(subprocess.CalledProcessError(proc.returncode, cmd))
+    def git_hash(self):
+        return self.git_output(cmd_git_hash) # hash
+    def git_fields(self, cmd):
+        fields = self.run_stream(cmd)
+        try:
+            for field in fields:
+                yield field.decode(git_encoding)
+        except subprocess.CalledProcessError as e:
+            self.git_failed(e)
+        finally:
+            fields.close() # waits for git if we stopped reading
+    def git_diff_fields(self, since, target, statuses):
+        # the diff of two commits never changes: with --changes-cache, syncs of the
+        # same commits (e.g. one branch into several vss projects) list it once
+        cmd = cmd_git_diff.format(self.rename_opt, statuses, since, target)
+        if self.changes_cache is None:
+            yield from self.git_fields(cmd)
+            return
+        name = since + ".." + target + "." + statuses + self.rename_opt.replace("%", "")
+        path = os.path.join(self.changes_cache, name)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            os.makedirs(self.changes_cache, exist_ok=True)
+            tmp = path + "." + str(os.getpid()) + ".tmp"
+            fields = self.run_stream(cmd)
+            try:
+                with open(tmp, "wb") as out:
+                    for field in fields: # raises if git failed
+                        out.write(field + b"\0")
+                        yield field.decode(git_encoding)
+                try:
+                    os.replace(tmp, path) # complete and git succeeded, others may use it
+                except OSError: # another sync stored it first
+                    pass
+            except subprocess.CalledProcessError as e:
+                self.git_failed(e)
+            finally:
+                fields.close()
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            return
+        with f:
+            for field in split_fields(f):
+                yield field.decode(git_encoding)
+    def git_changes(self, since, target, statuses="ACDMRT"):
+        # changes from a commit to target with one of statuses, as git lists them
+        if since is None: # everything in target is new
+            since = git_empty_tree
+        fields = self.git_diff_fields(since.strip(), target.strip(), statuses)
+        try:
+            for header in fields:
+                # :old_mode new_mode old_blob new_blob status, then one or two paths
+                try:
+                    old_mode, new_mode, old_blob, new_blob, status = header[1:].split()
+                    status = status[0]
+                    paths = [next(fields), next(fields)] if status in "RC" else [next(fields)]
+                except (ValueError, StopIteration): # cut off, reading on stops if git failed
+                    for field in fields:
+                        pass
+                    self.fatal_error("git diff listed a malformed change", self.vss_proj, "")
+                if git_mode_link in (old_mode, new_mode):
+                    continue
+                if status == change_modified and old_blob == new_blob: # mode-only change
+                    continue
+                if status == "T": # type change
+                    status = change_modified
+                if status == "C": # copy
+                    status = change_added
+                old_path = paths[0] if len(paths) == 2 else None
+                yield Change(status, paths[-1], old_path, new_blob, old_blob)
+        finally:
+            fields.close() # stops git if we stopped reading
+    def git_renames(self, since, target):
+        if since is None or self.rename_opt == "--no-renames":
+            return []
+        return list(self.git_changes(since, target, change_renamed))
+    def git_changes_prefetch(self, since, target):
+        # list the changes of a later sync on a thread while vss works on this one;
+        # the diff needs the commits only, not the checkout, and the queue bounds
+        # the changes held in memory, git waits for the sync to read the rest
+        pending = queue.Queue(stream_queue)
+        def produce():
+            self.worker.cwd = self.base_dir # the main thread changes folders
+            changes = self.git_changes(since, target, "ACDMT")
+            try:
+                if not self.listing_put(pending, self.git_renames(since, target)): # few, wanted first
+                    return
+                for change in changes:
+                    if not self.listing_put(pending, change):
+                        return
+                self.listing_put(pending, None)
+            except Exception as e: # hand it over to the sync
+                self.listing_put(pending, e)
+            finally:
+                changes.close() # stops git if the run is over
+        self.listing_start(produce)
+        def wait():
+            renames = pending.get()
+            if isinstance(renames, Exception):
+                self.fatal_raise(renames)
+            return self.queue_items(pending), renames
+        return wait
+    def local_names(self, subproj):
+        # lower-case name -> names in a folder of the checkout, recent folders cached
+        names = self.local_names_cache.pop(subproj, None)
+        if names is None:
+            names = dict()
+            if self.use_sparse: # only changed files are checked out, ask git
+                listing = [os.path.basename(path) for path in self.git_output(cmd_git_names.format(subproj + "/" if subproj != "" else ".")).split("\0") if path != ""]
+            else:
+                try:
+                    listing = os.listdir(os.path.join(self.base_dir, subproj))
+                except OSError: # folder gone from git
+                    listing = []
+            for name in listing:
+                names.setdefault(name.lower(), []).append(name)
+        self.local_names_cache[subproj] = names
+        if len(self.local_names_cache) > local_names_max:
+            self.local_names_cache.popitem(last=False)
+        return names
+    def local_case(self, path):
+        # path as spelt in the checkout, matching case-insensitively, if there
+        actual = ""
+        for part in path.split("/"):
+            names = self.local_names(actual).get(part.lower(), [])
+            if len(names) == 0:
+                return None
+            actual = subproj_join(actual, part if part in names else min(names))
+        return actual
+    def git_changes_case(self, changes):
+        # vss names are case-insensitive: a path deleted but still in the checkout
+        # with another case is a case-only rename, anything else clashing is
+        # dropped; the checkout is the reference, so only the folders being listed
+        # are held in memory
+        try:
+            renamed = set() # case-only renames, their added half is not synced again
+            for change in changes:
+                subproj, filename = os.path.split(change.path)
+                if change.status == change_deleted:
+                    path = self.local_case(change.path)
+                    if path is None or self.git_dir_exists(path): # not a file of another case, e.g. a folder in its place
+                        yield change
+                    else:
+                        renamed.add(path)
+                        yield Change(change_renamed, path, change.path, None, change.old_blob)
+                    continue
+                names = self.local_names(subproj).get(filename.lower(), [])
+                if len(names) > 1 and min(names) != filename:
+                    warn("ignoring " + change.path + ", its name differs only in case from " + subproj_join(subproj, min(names)), self.vss_proj)
+                elif change.path in renamed:
+                    renamed.discard(change.path)
+                else:
+                    yield change
+        finally:
+            changes.close()
+    def git_dirs(self):
+        return set(path.lower() for path in self.git_output(cmd_git_dirs).split("\0") if path != "") # lower-case directories at HEAD
+    def git_dirs_cached(self):
+        with self.sync_lock:
+            if self.git_head_dirs is None:
+                self.git_head_dirs = self.git_dirs()
+            return self.git_head_dirs
+    def git_dir_exists(self, subproj):
+        # from the tree rather than the checkout, which may be sparse
+        return subproj == "" or subproj.lower() in self.git_dirs_cached()
+    def git_revs(self, since, until):
+        commit_range = until if since is None else since + ".." + until
+        return self.git_output(cmd_git_revs.format(commit_range)).split() # oldest first
+    def git_untracked(self):
+        return [entry[3:] for entry in self.git_output(cmd_git_status).split("\0") if entry[:2] in ("??", "!!")] # untracked or ignored paths
+    def git_clone(self):
+        os.makedirs(self.base_dir)
+        print ("Cloning {} into {}".format(self.git_repo, self.base_dir))
+        self.git_call(cmd_git_clone.format(self.git_branch, self.clone_opts, self.git_repo, self.base_dir))
+    def git_fetch(self):
+        os.chdir(self.base_dir)
+        print ("Fetching latest changes from {}".format(self.git_repo))
+        self.git_call(cmd_git_fetch.format(self.git_branch))
+    def git_deepen(self, commit):
+        # a shallow clone fetches older history, further each time, until the
+        # last sync commit is in it
+        deepen = max(self.depth, 1)
+        while self.git_output(cmd_git_shallow).strip() == "true" and commit not in self.git_output(cmd_git_history).split():
+            print ("Fetching " + str(deepen) + " older commits to reach " + commit[:7])
+            self.git_call(cmd_git_deepen.format(deepen, self.git_branch))
+            deepen = deepen * 2
+    def git_sparse(self, paths):
+        # check out only paths, every file if None; the untracked .gitcommit keeps
+        # the list from being empty
+        patterns = ["/*"] if paths is None else [sparse_pattern(path) for path in paths]
+        with open(os.path.join(self.base_dir, ".git", "info", "sparse-checkout"), "w", encoding=git_encoding) as f:
+            f.write("\n".join([sparse_pattern(gitcommit_file)] + patterns) + "\n")
+    def git_sparse_init(self):
+        sparse_file = os.path.join(self.base_dir, ".git", "info", "sparse-checkout")
+        if self.use_sparse:
+            os.makedirs(os.path.dirname(sparse_file), exist_ok=True)
+            self.git_call(cmd_git_sparse.format("true"), quiet=True)
+            self.git_call(cmd_git_sparse_cone, quiet=True)
+            self.git_sparse([]) # nothing until a sync knows its changes
+        elif os.path.exists(sparse_file): # was sparse, check out every file again
+            self.git_call(cmd_git_sparse_off, quiet=True)
+            os.remove(sparse_file)
+    def git_checkout(self, since, target):
+        if self.use_sparse:
+            self.git_sparse(None if since is None else self.git_output(cmd_git_changed.format(since, target)).split("\0")[:-1])
+        self.git_call(cmd_git_ckout.format(target), quiet=True, check=True)
+        if self.use_sparse: # drop what the previous sync needed
+            self.git_call(cmd_git_sparse_apply, quiet=True, check=True)
+    ###########################################################################
+    # helper functions---journal                                              #
+    ###########################################################################
+    def journal_read(self):
+        # (since, target, set of done changes) of an interrupted sync, if any
+        try:
+            with open(os.path.join(self.base_dir, journal_file), "r", encoding=git_encoding) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return None
+        if len(lines) == 0 or len(lines[0].split()) != 3:
+            return None
+        _, since, target = lines[0].split()
+        done = set()
+        for line in lines[1:]:
+            fields = line.split("\t")
+            if len(fields) == 3 and fields[0] == target:
+                done.add(fields[1] + "\t" + fields[2].lower())
+        return since, target, done
+    def journal_open(self, since, target):
+        since = since or "-"
+        previous = self.journal_read()
+        self.journal_target = target
+        if self.dry_run: # plan what is left, the journal stays as it is
+            self.journal_done = previous[2] if previous is not None and previous[:2] == (since, target) else set()
+            return
+        if previous is not None and previous[:2] == (since, target):
+            self.journal_done = previous[2]
+            self.journal = open(os.path.join(self.base_dir, journal_file), "a", encoding=git_encoding)
+            if len(self.journal_done) > 0:
+                print ("Resuming interrupted sync, " + str(len(self.journal_done)) + " changes already done")
+        else:
+            self.journal_done = set()
+            self.journal = open(os.path.join(self.base_dir, journal_file), "w", encoding=git_encoding)
+            self.journal.write("sync " + since + " " + target + "\n")
+    def journal_close(self):
+        self.journal.close()
+        self.journal = None
+        os.remove(os.path.join(self.base_dir, journal_file))
+    def journal_has(self, status, path):
+        return status + "\t" + path.lower() in self.journal_done
+    def journal_add(self, status, path):
+        with self.sync_lock:
+            if self.journal is None or self.journal_has(status, path):
+                return
+            self.journal_done.add(status + "\t" + path.lower())
+            self.journal.write(self.journal_target + "\t" + status + "\t" + path + "\n")
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+    def journal_pending(self, changes):
+        for change in changes:
+            if self.journal_has(change.status, change.path):
+                self.progress_count(-1)
+            else:
+                yield change
+    ###########################################################################
+    # helper functions---manifest                                             #
+    ###########################################################################
+    def manifest_header(self, commit):
+        return "manifest\t" + (commit or "-") + "\t" + self.vss_proj
+    def manifest_load(self, commit):
+        # the manifest holds for the vss project at its .gitcommit, plus the files
+        # pushed since; if it is for another commit (or project) rebuild it
+        path = os.path.join(self.base_dir, manifest_file)
+        self.manifest.clear()
+        try:
+            with open(path, "r", encoding=git_encoding) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            lines = []
+        if self.rebuild_manifest or len(lines) == 0 or lines[0] != self.manifest_header(commit):
+            self.manifest_rebuild(commit)
+        else:
+            for line in lines[1:]:
+                blob, _, filepath = line.partition("\t")
+                if blob == "-":
+                    self.manifest.pop(filepath.lower(), None)
+                elif filepath != "":
+                    self.manifest[filepath.lower()] = blob
+        self.manifest_out = open(path, "a", encoding=git_encoding)
+    def manifest_rebuild(self, commit):
+        # files vss has, as of the tree of the last sync commit
+        print ("Rebuilding the manifest from " + (commit[:7] if commit is not None else "scratch"))
+        if commit is not None:
+            for entry in self.git_output(cmd_git_files.format(commit)).split("\0"):
+                info, _, filepath = entry.partition("\t")
+                if info.split(" ")[1:2] == ["blob"] and self.vss_snap_file(os.path.dirname(filepath), os.path.basename(filepath)) is not None:
+                    self.manifest[filepath.lower()] = info.split(" ")[2]
+        self.manifest_save(commit)
+    def manifest_save(self, commit):
+        # after a sync, vss has the tree of commit
+        if self.manifest_out is not None:
+            self.manifest_out.close()
+            self.manifest_out = None
+        path = os.path.join(self.base_dir, manifest_file)
+        with open(path + ".tmp", "w", encoding=git_encoding) as f:
+            f.write(self.manifest_header(commit) + "\n")
+            for key in sorted(self.manifest):
+                f.write(self.manifest[key] + "\t" + key + "\n")
+        os.replace(path + ".tmp", path)
+        self.manifest_out = open(path, "a", encoding=git_encoding)
+    def manifest_set(self, path, blob):
+        with self.sync_lock:
+            if blob is None:
+                self.manifest.pop(path.lower(), None)
+            else:
+                self.manifest[path.lower()] = blob
+            if self.manifest_out is not None:
+                self.manifest_out.write((blob or "-") + "\t" + path.lower() + "\n")
+                self.manifest_out.flush()
+    def manifest_drop(self, subproj):
+        # subproj deleted from vss with all its files
+        with self.sync_lock:
+            prefix = subproj.lower() + "/"
+            for path in [path for path in self.manifest if path.startswith(prefix)]:
+                self.manifest_set(path, None)
+    def manifest_done(self, change):
+        # change pushed to vss
+        if change.status == change_deleted:
+            self.manifest_set(change.path, None)
+        elif change.status == change_renamed: # no blob if the content is unknown
+            self.manifest_set(change.old_path, None)
+            self.manifest_set(change.path, change.blob)
+        else:
+            self.manifest_set(change.path, change.blob)
+    def manifest_pending(self, changes):
+        # files vss already has with the same content are not checked in again
+        for change in changes:
+            subproj, filename = os.path.split(change.path)
+            if change.status in (change_added, change_modified) and change.blob is not None and self.manifest.get(change.path.lower()) == change.blob and self.vss_snap_file(subproj, filename) == filename:
+                self.journal_add(change.status, change.path)
+                self.progress_count(-1)
+                self.manifest_skipped = self.manifest_skipped + 1
+            else:
+                yield change
+    ###########################################################################
+    # helper functions---renames                                              #
+    ###########################################################################
+    def rename_subproj_ok(self, old_root, new_root, group):
+        old_parent, old_name = os.path.split(old_root)
+        new_parent, new_name = os.path.split(new_root)
+        if self.vss_snap_subproj(old_root) is None or self.vss_snap_subproj(new_root) is not None:
+            return False
+        if self.vss_snap_file(new_parent, new_name) is not None:
+            return False
+        if (old_root + "/").lower().startswith((new_root + "/").lower()) or (new_root + "/").lower().startswith((old_root + "/").lower()):
+            return False
+        if old_name.lower() != new_name.lower() and old_parent.lower() != new_parent.lower():
+            # renamed in place before moving
+            if self.vss_snap_subproj(subproj_join(old_parent, new_name)) is not None or self.vss_snap_file(old_parent, new_name) is not None:
+                return False
+        # the move must not take anything along that git did not move
+        return self.vss_snap_tree_files(old_root) <= set(change.old_path.lower() for change in group)
+    def vss_move_subproj(self, old_root, new_root):
+        old_parent, old_name = os.path.split(old_root)
+        new_parent, new_name = os.path.split(new_root)
+        self.vss_cd_forget()
+        try:
+            if self.vss_snap_subproj(old_root) != new_name: # rename in place
+                renamed = subproj_join(old_parent, new_name)
+                self.vss_call(cmd_vss_rename.format(self.vss_path(old_root), self.vss_path(renamed)), old_root)
+                self.vss_snap_move_subproj(old_root, renamed)
+                old_root = renamed
+            if old_parent.lower() != new_parent.lower(): # move to the new parent
+                self.vss_cd_create(new_parent)
+                self.vss_call(cmd_vss_move.format(self.vss_path(old_root), self.vss_path(new_parent)), old_root)
+                self.vss_snap_move_subproj(old_root, new_root)
+        except subprocess.CalledProcessError as e:
+            err = vss_get_error(e)
+            self.fatal_error(err, old_root, "")
+        if not self.git_dir_exists(old_parent):
+            self.vss_delete_empty_subproj(old_parent)
+    def rename_file_ok(self, change):
+        old_subproj, old_name = os.path.split(change.old_path)
+        subproj, filename = os.path.split(change.path)
+        vss_name = self.vss_snap_file(old_subproj, old_name)
+        if vss_name is not None and change.path.lower() == change.old_path.lower(): # case-only
+            return True
+        if vss_name is None or self.vss_snap_file(subproj, filename) is not None or self.vss_snap_subproj(change.path) is not None:
+            return False
+        return old_subproj.lower() == subproj.lower() or self.vss_snap_file(subproj, vss_name) is None
+    def rename_file(self, change):
+        old_subproj, old_name = os.path.split(change.old_path)
+        subproj, filename = os.path.split(change.path)
+        vss_name = self.vss_snap_file(old_subproj, old_name)
+        self.vss_cd_create(subproj)
+        if change.path.lower() == change.old_path.lower(): # case-only, vss_cd_create renamed the folders
+            self.vss_rename_case(subproj, vss_name, filename)
+            return
+        try:
+            if old_subproj.lower() == subproj.lower(): # rename
+                self.vss_call(cmd_vss_rename.format(vss_name, filename), subproj)
+            else: # no file moves in vss, share, branch and delete the original
+                self.vss_call(cmd_vss_share.format(self.vss_path(subproj_join(old_subproj, vss_name))), subproj)
+                self.vss_call(cmd_vss_branch.format(vss_name), subproj)
+                if vss_name != filename:
+                    self.vss_call(cmd_vss_rename.format(vss_name, filename), subproj)
+                self.vss_destroy(old_subproj, vss_name)
+        except subprocess.CalledProcessError as e:
+            err = vss_get_error(e)
+            self.fatal_error(err, subproj, filename)
+        self.vss_snap_del_file(old_subproj, old_name)
+        self.vss_snap_add_file(subproj, filename)
+        if not self.git_dir_exists(old_subproj):
+            self.vss_delete_empty_subproj(old_subproj)
+    def plan_renames(self, changes, left):
+        # git renames as vss moves and renames; what is left to do goes to left:
+        # content changes of renamed files and renames vss could not follow, as a
+        # delete and an add
+        def is_rename(change):
+            # case-only renames too when git kept the content, vss_add_or_modify
+            # would check it out and in for nothing
+            if change.status != change_renamed:
+                return False
+            return change.path.lower() != change.old_path.lower() or change.blob == change.old_blob
+        renames = [change for change in changes if is_rename(change)]
+        left.extend(change for change in changes if not is_rename(change))
+        # move whole subprojects when git moved every file in them
+        candidates = dict()
+        for change in renames:
+            if not self.journal_has(change_renamed, change.path):
+                for root in rename_roots(change):
+                    candidates.setdefault(root, []).append(change)
+        moved = set()
+        for old_root, new_root in sorted(candidates, key=lambda root: root[0].count("/")):
+            group = candidates[(old_root, new_root)]
+            if any(change.path in moved for change in group) or not self.rename_subproj_ok(old_root, new_root, group):
+                continue
+            self.progress_count(len(group))
+            yield Op(op_move, old_root, [new_root], group)
+            moved.update(change.path for change in group)
+        for change in renames:
+            done = self.journal_has(change_renamed, change.path) or change.path in moved
+            if not done and self.rename_file_ok(change):
+                self.progress_count(1)
+                yield Op(op_rename, os.path.dirname(change.path), [os.path.basename(change.path)], [change])
+                done = True
+            subproj, filename = os.path.split(change.path)
+            if not done: # sync as a delete and an add
+                left.append(Change(change_deleted, change.old_path, None, change.old_blob, change.old_blob))
+                left.append(Change(change_added, change.path, None, change.blob, None))
+            elif change.blob != change.old_blob or self.vss_snap_file(subproj, filename) is None:
+                left.append(Change(change_modified, change.path, None, change.blob, change.old_blob))
+        self.progress_count(len(left))
+    ###########################################################################
+    # helper functions---deleted subprojects                                  #
+    ###########################################################################
+    def vss_delete_tree(self, root):
+        try:
+            self.vss_destroy(os.path.dirname(root), self.vss_snap_subproj(root))
+        except subprocess.CalledProcessError as e:
+            err = vss_get_error(e)
+            self.fatal_error(err, root, "")
+        self.vss_snap_del_subproj(root)
+    ###########################################################################
+    # helper functions---sync                                                 #
+    ###########################################################################
+    def op_describe(self, op):
+        if op.kind == op_move:
+            return "Moving " + op.subproj + " to " + op.names[0] + " (" + str(len(op.changes)) + " files)"
+        if op.kind == op_rename:
+            return "Renaming " + op.changes[0].old_path + " to " + op.changes[0].path
+        if op.kind == op_delete_tree:
+            return "Deleting " + op.subproj + " (" + str(len(self.vss_snap_tree_files(op.subproj))) + " files)"
+        if op.kind == op_delete_file:
+            return "Deleting " + subproj_join(op.subproj, op.names[0]) + " (replaced by a folder)"
+        if op.kind == op_import:
+            return "Importing " + str(len(op.names)) + " subprojects (" + str(len(op.changes)) + " files)"
+        if op.kind == op_create:
+            return "Creating " + self.vss_path(op.subproj)
+        verb = {op_add: "Adding", op_checkin: "Modifying", op_delete: "Deleting"}[op.kind]
+        if len(op.names) == 1:
+            return verb + " " + subproj_join(op.subproj, op.names[0])
+        return verb + " " + str(len(op.names)) + " files in " + self.vss_path(op.subproj)
+    def apply_op(self, op, label, batched):
+        print (label + " " + self.op_describe(op))
+        calls = getattr(self.worker, "calls", 0)
+        if op.kind == op_move:
+            self.vss_move_subproj(op.subproj, op.names[0])
+        elif op.kind == op_rename:
+            self.rename_file(op.changes[0])
+        elif op.kind == op_delete_tree:
+            self.vss_delete_tree(op.subproj)
+        elif op.kind == op_delete_file:
+            self.vss_delete(op.subproj, op.names[0])
+        elif op.kind == op_import:
+            self.vss_import(op.names, op.changes)
+        elif op.kind == op_create:
+            self.vss_create(op.subproj)
+        elif not batched:
+            self.local_cd(self.base_dir)
+            if op.kind == op_delete:
+                self.vss_delete(op.subproj, op.names[0])
+            else: # vss_add_or_modify also follows case-only renames
+                self.vss_add_or_modify(op.subproj, op.names[0])
+        elif op.kind == op_add:
+            self.vss_add_batch(op.subproj, op.names)
+        elif op.kind == op_checkin:
+            self.vss_ckin_batch(op.subproj, op.names)
+        else:
+            self.vss_del_batch(op.subproj, op.names)
+        if batched and op.kind in (op_import, op_add, op_checkin, op_delete): # the ones vss_per_file_cost counts
+            with self.sync_lock:
+                self.vss_calls_batched = self.vss_calls_batched + getattr(self.worker, "calls", 0) - calls
+        self.op_done(op)
+    def op_done(self, op):
+        # record the changes of an applied operation in the manifest and journal
+        if self.dry_run:
+            return
+        if op.kind == op_delete_tree:
+            self.manifest_drop(op.subproj)
+        if op.kind == op_delete_file: # its change is skipped later, vss no longer has it
+            self.manifest_set(subproj_join(op.subproj, op.names[0]), None)
+        for change in op.changes:
+            if op.kind in (op_move, op_rename): # content changes follow apart
+                change = Change(change_renamed, change.path, change.old_path, change.old_blob, change.old_blob)
+            self.manifest_done(change)
+            self.journal_add(change.status, change.path)
+    def progress_count(self, n):
+        # n more changes listed (fewer if negative)
+        with self.sync_lock:
+            self.sync_total = self.sync_total + n
+    def progress(self, n):
+        # label of the next n changes: position, throughput and, once git has
+        # listed every change, estimated time left
+        with self.sync_lock:
+            done = self.sync_done
+            self.sync_done = self.sync_done + n
+            label = str(done + 1) + "/" + str(self.sync_total) + ("" if self.sync_listed else "+")
+        elapsed = time.perf_counter() - self.sync_start
+        if done == 0 or elapsed <= 0:
+            return label
+        rate = done / elapsed
+        label = label + " [{:.1f}/s".format(rate)
+        if self.sync_listed:
+            left = int(max(self.sync_total - done, 0) / rate)
+            label = label + " ETA {}:{:02}:{:02}".format(left // 3600, left // 60 % 60, left % 60)
+        return label + "]"
+    def apply_ops(self, ops, batched):
+        for op in ops:
+            self.apply_op(op, "  " if self.dry_run else self.progress(len(op.changes)), batched)
+    def stream_changes(self, changes):
+        # list changes on a thread of their own so that vss work starts while git
+        # is still listing them; the queue bounds the changes held in memory
+        pending = queue.Queue(stream_queue)
+        def produce():
+            try:
+                for change in changes:
+                    self.progress_count(1)
+                    if not self.listing_put(pending, change):
+                        return
+                self.sync_listed = True
+                self.listing_put(pending, None)
+            except Exception as e: # hand it over to the consumer
+                self.listing_put(pending, e)
+            finally:
+                changes.close() # stops git if the run is over
+        self.sync_listed = False
+        self.listing_start(produce)
+        return self.queue_items(pending)
+    def listing_start(self, produce):
+        thread = threading.Thread(target=produce, daemon=True)
+        self.listing_threads.append(thread)
+        thread.start()
+    def listing_put(self, pending, item):
+        # False once the run is over, nobody reads what a producer lists then
+        while not self.listing_cancel.is_set():
+            try:
+                pending.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def listing_stop(self):
+        # the producers still listing stop and wait for their git commands
+        self.listing_cancel.set()
+        for thread in self.listing_threads:
+            thread.join()
+        self.listing_threads = []
+    def queue_items(self, pending):
+        # items a producer thread puts in pending until None, raising its error;
+        # none once the run is over, the producer may have stopped
+        while True:
+            try:
+                item = pending.get(timeout=1)
+            except queue.Empty:
+                if self.listing_cancel.is_set():
+                    return
+                continue
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                self.fatal_raise(item)
+            yield item
+    def sync_targets(self, since, head):
+        # commits to sync to in order, each one is recorded in .gitcommit
+        targets = []
+        previous = self.journal_read()
+        if previous is not None and previous[0] == (since or "-") and previous[1] != head:
+            targets.append(previous[1]) # finish the interrupted sync first
+            since = previous[1]
+        if self.use_replay:
+            targets.extend(self.replay_targets(since, head)[:-1])
+        elif self.checkpoint > 0:
+            targets.extend(self.git_revs(since, head)[self.checkpoint - 1:-1:self.checkpoint])
+        targets.append(head)
+        return targets
+    def sync(self, since, target, listed=None):
+        # listed, if given, returns the changes git listed ahead of this sync
+        self.sync_done = 0
+        self.sync_total = 0
+        self.sync_start = time.perf_counter()
+        self.vss_calls_per_file = 0
+        self.vss_calls_batched = 0
+        self.manifest_skipped = 0
+        os.chdir(self.base_dir)
+        self.git_checkout(since, target)
+        self.git_head_dirs = None
+        self.local_names_cache.clear()
+        self.replay_comment(since, target)
+        if since is None:
+            print ("Replaying from first git commit until " + target[:7] + " (.gitcommit not found)")
+        else:
+            print ("Replaying from " + since[:7] + " until " + target[:7])
+        self.journal_open(since, target)
+        # git lists changes while renames, which are few, are applied first
+        if listed is None:
+            changes = self.stream_changes(self.git_changes_case(self.git_changes(since, target, "ACDMT")))
+            renames = self.git_renames(since, target)
+        else:
+            changes, renames = listed()
+            changes = self.stream_changes(self.git_changes_case(changes))
+        ops = self.plan_sync(since, changes, renames)
+        batched = self.use_batch or since is None # the initial import adds in bulk
+        if self.jobs > 1 and not self.dry_run:
+            self.process_parallel(ops, batched)
+        else:
+            self.apply_ops(ops, batched)
+        if self.manifest_skipped > 0:
+            print ("Skipped " + str(self.manifest_skipped) + " files VSS already has")
+        if self.dry_run: # .gitcommit would be updated, nothing else is recorded
+            self.vss_cd_root()
+            self.vss_git_hash_set(target)
+            return
+        print ("All changes processed")
+        if batched:
+            saved = max(0, self.vss_calls_per_file - self.vss_calls_batched)
+            print ("Issued " + str(self.vss_calls_batched) + " ss calls to add, check in and delete files, " + str(saved) + " fewer than the per-file sync would have (estimated)")
+        self.vss_cd_root()
+        # update last sync commit hash
+        self.vss_git_hash_set(target)
+        self.manifest_save(target)
+        self.journal_close()
+    ###########################################################################
+    # helper functions---replay                                               #
+    ###########################################################################
+    def replay_commits(self, since, until):
+        # [commit, commit time, files changed] along the first-parent history
+        commit_range = until if since is None else since + ".." + until
+        commits = []
+        for line in self.git_output(cmd_git_commits.format(commit_range)).splitlines():
+            if line.startswith("\0"):
+                commit, commit_time = line[1:].split()
+                commits.append([commit, int(commit_time), 0])
+            elif line != "" and len(commits) > 0:
+                commits[-1][2] = commits[-1][2] + 1
+        return commits
+    def replay_targets(self, since, head):
+        # last commit of each replay batch; a commit joins the batch before it if
+        # made within replay_window seconds of its first commit or if the batch
+        # still changes at most replay_files files with it
+        targets = []
+        first_time = None
+        files = 0
+        for commit, commit_time, changed in self.replay_commits(since, head):
+            if first_time is not None and ((self.replay_window > 0 and commit_time - first_time <= self.replay_window) or files + changed <= self.replay_files):
+                targets[-1] = commit
+                files = files + changed
+            else:
+                targets.append(commit)
+                first_time = commit_time
+                files = changed
+        return targets
+    def replay_comment(self, since, target):
+        # the messages of the commits synced become the comment of every vss
+        # add and checkin, through a file as they span several lines
+        if not self.use_replay:
+            return
+        commit_range = target if since is None else since + ".." + target
+        message = self.git_output(cmd_git_message.format(commit_range)).strip()
+        path = os.path.abspath(comment_file) # in base_dir, workers have their own folders
+        with open(path, "w", encoding=vss_encoding, errors="replace") as f:
+            f.write(message + "\n")
+        self.vss_comment = ' -C@"' + path + '"'
+    ###########################################################################
+    # helper functions---batched sync                                         #
+    ###########################################################################
+    def file_chunks(self, cmd, files):
+        # split files so that no command line exceeds cmdlen_vss, shorter lines
+        # when the database is contended
+        chunk = []
+        size = len(cmd) + len(self.vss_comment)
+        for filename in files:
+            if chunk and size + len(filename) + 3 > self.cmdlen_allowed():
+                yield chunk
+                chunk = []
+                size = len(cmd) + len(self.vss_comment)
+            chunk.append(filename)
+            size = size + len(filename) + 3
+        if chunk:
+            yield chunk
+    def vss_add_files(self, subproj, files):
+        for chunk in self.file_chunks(cmd_vss_add_files, files):
+            try:
+                self.vss_call(cmd_vss_add_files.format(quote_files(chunk)), subproj)
+            except subprocess.CalledProcessError:
+                self.trace_expected()
+                for filename in chunk: # retry one by one, some may have been added
+                    try:
+                        self.vss_call(cmd_vss_add.format(filename), subproj)
+                    except subprocess.CalledProcessError as e:
+                        err = vss_get_error(e)
+                        if not err.endswith("already exists"):
+                            self.fatal_error(err, subproj, filename)
+                        self.trace_expected()
+    def vss_ckout_files(self, subproj, files):
+        for chunk in self.file_chunks(cmd_vss_ckout_files, files):
+            try:
+                self.vss_call(cmd_vss_ckout_files.format(quote_files(chunk)), subproj)
+            except subprocess.CalledProcessError:
+                self.trace_expected()
+                for filename in chunk: # retry one by one, some may have been checked out
+                    try:
+                        self.vss_call(cmd_vss_ckout.format(filename), subproj)
+                    except subprocess.CalledProcessError as e:
+                        err = vss_get_error(e)
+                        if "You currently have" not in err: # unless we already have the file checked out, something went wrong
+                            self.fatal_error(err, subproj, filename)
+                        self.trace_expected()
+    def vss_ckin_files(self, subproj, files):
+        for chunk in self.file_chunks(cmd_vss_ckin_files, files):
+            try:
+                self.vss_call(cmd_vss_ckin_files.format(quote_files(chunk)), subproj)
+            except subprocess.CalledProcessError as e: # could not checkin, something went wrong
+                err = vss_get_error(e)
+                self.fatal_error(err, subproj, "")
+    def vss_del_files(self, subproj, files):
+        for chunk in self.file_chunks(cmd_vss_del_files, files):
+            try:
+                self.vss_call(cmd_vss_del_files.format(quote_files(chunk)), subproj)
+            except subprocess.CalledProcessError:
+                self.trace_expected()
+                for filename in chunk: # retry one by one, some may have been deleted
+                    try:
+                        self.vss_call(cmd_vss_del.format(filename), subproj)
+                    except subprocess.CalledProcessError as e:
+                        err = vss_get_error(e)
+                        if "has been deleted" not in err: # unless the file has already been deleted, something went wrong
+                            self.fatal_error(err, subproj, filename)
+                        self.trace_expected()
+    def vss_add_batch(self, subproj, files):
+        with self.sync_lock:
+            self.vss_calls_per_file = self.vss_calls_per_file + vss_per_file_cost(len(files), False, False)
+        self.vss_cd_create(subproj)
+        self.vss_add_files(subproj, files)
+        for filename in files:
+            self.vss_snap_add_file(subproj, filename)
+    def vss_ckin_batch(self, subproj, files):
+        with self.sync_lock:
+            self.vss_calls_per_file = self.vss_calls_per_file + vss_per_file_cost(len(files), True, False)
+        existing = dict(self.vss_snap_files.get(subproj.lower(), dict()))
+        self.vss_cd_create(subproj)
+        self.vss_ckout_files(subproj, files)
+        self.vss_ckin_files(subproj, files)
+        for filename in files:
+            self.vss_rename_case(subproj, existing.get(filename.lower(), filename), filename)
+    def vss_del_batch(self, subproj, files):
+        existing = dict(self.vss_snap_files.get(subproj.lower(), dict()))
+        files = [existing[filename.lower()] for filename in files if filename.lower() in existing]
+        if len(files) == 0: # nothing to do
+            return
+        with self.sync_lock:
+            self.vss_calls_per_file = self.vss_calls_per_file + vss_per_file_cost(len(files), True, True)
+        try: # change vss project
+            self.vss_cd(subproj)
+        except subprocess.CalledProcessError as e:
+            err = vss_get_error(e)
+            self.fatal_error(err, subproj, "")
+        self.vss_ckout_files(subproj, files)
+        renamed = []
+        for filename in files:
+            try: # rename
+                ts = str(time.time())[:ts_size]
+                new_filename = self.trunc_filename(subproj, filename) + ts
+                self.vss_call(cmd_vss_rename.format(filename, new_filename), subproj)
+                renamed.append(new_filename)
+            except subprocess.CalledProcessError as e: # could not rename, something went wrong
+                err = vss_get_error(e)
+                self.fatal_error(err, subproj, filename)
+        self.vss_del_files(subproj, renamed)
+        for filename in files:
+            self.vss_snap_del_file(subproj, filename)
+        if not self.git_dir_exists(subproj):
+            self.vss_delete_empty_subproj(subproj)
+    ###########################################################################
+    # helper functions---plan                                                 #
+    ###########################################################################
+    def plan_sync(self, since, changes, renames):
+        # the vss operations of a sync in the order they are applied; each one is
+        # planned against the snapshot the ones before it leave, so it has to be
+        # applied (or simulated, in a dry run) before the next one is planned
+        left = []
+        yield from self.plan_renames(renames, left)
+        changes = self.manifest_pending(self.journal_pending(itertools.chain(left, changes)))
+        if since is None: # initial import, add in bulk
+            yield from self.plan_import(list(changes))
+        else:
+            yield from self.plan_changes(changes, self.use_batch)
+    def plan_changes(self, changes, batched):
+        # per folder: subprojects gone from git are deleted whole, then the folder
+        # is created if need be and its files are added, checked in and deleted,
+        # all at once if batched, so that each folder is entered once
+        dirs = None
+        seen = set() # lower-case roots gone from git
+        for subproj, group in group_changes(changes):
+            files = dict((kind, collections.OrderedDict()) for kind in (op_add, op_checkin, op_delete))
+            for change in group:
+                filename = os.path.basename(change.path)
+                if change.status == change_deleted:
+                    if dirs is None:
+                        dirs = self.git_dirs_cached()
+                    root = deleted_root(change.path, dirs)
+                    if root is not None and root.lower() not in seen:
+                        seen.add(root.lower())
+                        if self.vss_snap_subproj(root) is not None:
+                            yield Op(op_delete_tree, root, [], [])
+                    if self.vss_snap_file(subproj, filename) is None: # nothing in vss
+                        self.progress_count(-1)
+                        continue
+                    kind = op_delete
+                elif self.vss_snap_file(subproj, filename) is None:
+                    kind = op_add
+                else:
+                    kind = op_checkin
+                # a case-only rename and its added half are one file
+                files[kind].setdefault(filename.lower(), (filename, []))[1].append(change)
+            if len(files[op_add]) + len(files[op_checkin]) > 0 and self.vss_create_needed(subproj):
+                yield from self.plan_clashes(subproj)
+                yield Op(op_create, subproj, [], [])
+            for kind in (op_add, op_checkin, op_delete):
+                entries = list(files[kind].values())
+                if not batched:
+                    for filename, done in entries:
+                        yield Op(kind, subproj, [filename], done)
+                elif len(entries) > 0:
+                    yield Op(kind, subproj, [filename for filename, done in entries], [change for filename, done in entries for change in done])
+    def plan_clashes(self, subproj):
+        # files where subproj and its parents are to be created; a file replaced
+        # by a folder in git is deleted with its own folder's group, which comes
+        # after the groups of the folders below it
+        parent = ""
+        for dir in subproj.split("/") if subproj != "" else []:
+            path = subproj_join(parent, dir)
+            if self.vss_snap_subproj(path) is None and self.vss_snap_file(parent, dir) is not None:
+                yield Op(op_delete_file, parent, [dir], [])
+            parent = path
+    def plan_estimate(self):
+        # ss calls of a dry run, and their duration from the mean time of each
+        # command kind in the trace of the last run
+        try:
+            with open(self.trace_file, "r", encoding="utf8") as f:
+                kinds = json.load(f)["summary"]["kinds"]
+        except (OSError, ValueError, KeyError):
+            kinds = dict()
+        kinds = dict((kind, stats) for kind, stats in kinds.items() if kind.startswith("ss") and stats["calls"] > 0)
+        mean = None # of the kinds never recorded
+        if len(kinds) > 0:
+            mean = sum(stats["time"] for stats in kinds.values()) / sum(stats["calls"] for stats in kinds.values())
+        print ("Estimated " + str(sum(self.plan_calls.values())) + " ss calls:")
+        seconds = 0.0
+        for kind in sorted(self.plan_calls):
+            line = "  {:<16} {:>6} calls".format(kind, self.plan_calls[kind])
+            if mean is not None:
+                time_kind = self.plan_calls[kind] * (kinds[kind]["time"] / kinds[kind]["calls"] if kind in kinds else mean)
+                seconds = seconds + time_kind
+                line = line + " {:>9.1f}s".format(time_kind)
+            print (line)
+        if mean is None:
+            print ("No recorded timings in " + self.trace_file + " to estimate the duration")
+            return
+        left = int(seconds)
+        estimate = "{}:{:02}:{:02}".format(left // 3600, left // 60 % 60, left % 60)
+        if self.jobs > 1:
+            left = int(seconds / self.jobs)
+            estimate = estimate + " ({}:{:02}:{:02} at best with {} workers)".format(left // 3600, left // 60 % 60, left % 60, self.jobs)
+        print ("Estimated duration in ss " + estimate + ", from the timings in " + self.trace_file)
+    ###########################################################################
+    # helper functions---initial import                                       #
+    ###########################################################################
+    def plan_import(self, changes):
+        # nothing synced yet: add each top-level directory new to vss with one
+        # recursive add, create the other subprojects top-down in one pass and
+        # add the files left per directory
+        dirty = set(path.split("/")[0].lower() for path in self.git_untracked() if "/" in path)
+        tops = dict()
+        for change in changes:
+            if "/" in change.path:
+                top = change.path.split("/")[0]
+                tops.setdefault(top.lower(), (top, []))[1].append(change)
+        recursive = [tops[key] for key in sorted(tops) if key not in dirty and self.vss_snap_subproj(tops[key][0]) is None]
+        if len(recursive) > 0:
+            yield Op(op_import, "", [top for top, group in recursive], [change for top, group in recursive for change in group])
+        done = set(top.lower() for top, group in recursive)
+        changes = [change for change in changes if "/" not in change.path or change.path.split("/")[0].lower() not in done]
+        dirs = dict()
+        for change in changes:
+            subproj = os.path.dirname(change.path)
+            while subproj != "" and subproj.lower() not in dirs:
+                dirs[subproj.lower()] = subproj
+                subproj = os.path.dirname(subproj)
+        for key in sorted(dirs, key=lambda key: key.split("/")): # parents first
+            if self.vss_snap_subproj(dirs[key]) is None:
+                yield from self.plan_clashes(dirs[key])
+                yield Op(op_create, dirs[key], [], [])
+        yield from self.plan_changes(changes, True)
+    def vss_import(self, tops, changes):
+        try:
+            self.vss_cd("")
+            self.local_cd(self.base_dir)
+            for chunk in self.file_chunks(cmd_vss_add_tree, tops):
+                self.vss_call(cmd_vss_add_tree.format(quote_files(chunk)), "")
+        except subprocess.CalledProcessError as e:
+            err = vss_get_error(e)
+            self.fatal_error(err, "", "")
+        for change in changes:
+            self.vss_snap_add_file(os.path.dirname(change.path), os.path.basename(change.path))
+        with self.sync_lock:
+            self.vss_calls_per_file = self.vss_calls_per_file + vss_per_file_cost(len(changes), False, False)
+    ###########################################################################
+    # helper functions---parallel sync                                        #
+    ###########################################################################
+    def worker_env(self, n, tmp_dir):
+        # own ss.ini so that each worker has its own current project
+        ini = os.path.join(tmp_dir, "ss" + str(n) + ".ini")
+        user_ini = os.path.join(self.env["SSDIR"], "users", self.vss_user.lower(), "ss.ini")
+        if os.path.isfile(user_ini):
+            shutil.copyfile(user_ini, ini)
+        else:
+            open(ini, "w").close()
+        env = dict(self.env)
+        env["SSINI"] = ini
+        return env
+    def partition_ops(self, ops, batched):
+        # runs of operations on one subproject, git lists a folder's files
+        # together; long runs are cut so that workers start early, operations
+        # spanning subprojects are applied on the way by the main thread, and so
+        # are the creates of parents that workers on nested subprojects share
+        partition = []
+        for op in ops:
+            if op.kind in ops_global:
+                self.apply_op(op, self.progress(len(op.changes)), batched)
+                continue
+            if len(partition) > 0 and (op.subproj.lower() != partition[0].lower() or len(partition[1]) >= stream_queue):
+                yield partition
+                partition = []
+            if len(partition) == 0:
+                parent = os.path.dirname(op.subproj)
+                if self.vss_create_needed(parent):
+                    self.vss_create(parent)
+                partition = (op.subproj, [])
+            partition[1].append(op)
+        if len(partition) > 0:
+            yield partition
+    def worker_main(self, n, env, partitions, locks, slots, batched, failures):
+        self.worker.cwd = self.base_dir
+        self.worker.env = env
+        while True:
+            item = partitions.get()
+            if item is None: # no more work
+                return
+            subproj, ops = item
+            with self.sync_lock:
+                lock = locks.setdefault(subproj.lower(), threading.Lock())
+            try:
+                with lock: # one worker at a time per subproject
+                    with slots:
+                        while slots.active >= self.jobs_allowed(): # fewer workers under contention
+                            slots.wait(1)
+                        slots.active = slots.active + 1
+                    try:
+                        self.apply_ops(ops, batched)
+                    finally:
+                        with slots:
+                            slots.active = slots.active - 1
+                            slots.notify_all()
+            except Exception as e: # stop this worker, the others carry on
+                failures.append((n, subproj, str(e)))
+                return
+    def process_parallel(self, ops, batched):
+        # the files of a subproject are apart from those of any other, each
+        # partition is synced by one worker as soon as git has listed it
+        work = queue.Queue(self.jobs)
+        locks = dict()
+        slots = threading.Condition() # active counts the workers syncing
+        slots.active = 0
+        tmp_dir = tempfile.mkdtemp()
+        failures = []
+        workers = []
+        for n in range(self.jobs):
+            workers.append(threading.Thread(target=self.worker_main, args=(n + 1, self.worker_env(n + 1, tmp_dir), work, locks, slots, batched, failures)))
+        for thread in workers:
+            thread.start()
+        self.workers_running = True
+        error = None
+        dispatched = False
+        try:
+            for item in self.partition_ops(ops, batched):
+                while len(failures) == 0:
+                    try:
+                        work.put(item, timeout=1)
+                        break
+                    except queue.Full:
+                        pass
+                if len(failures) > 0: # the sync fails, plan and apply nothing more
+                    break
+            dispatched = True
+        except SyncError as e: # raised on the main thread, e.g. by a global operation
+            error = str(e)
+        finally:
+            # the workers stop before anything is reported, fatal_stop undoes the
+            # checkouts of the whole project
+            if not dispatched or len(failures) > 0: # drop the partitions not started
+                while True:
+                    try:
+                        work.get_nowait()
+                    except queue.Empty:
+                        break
+            for n in range(len(workers)):
+                while any(thread.is_alive() for thread in workers):
+                    try:
+                        work.put(None, timeout=1)
+                        break
+                    except queue.Full:
+                        pass
+            for thread in workers:
+                thread.join()
+            self.workers_running = False
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        if error is not None:
+            self.fatal_stop(error)
+        if len(failures) > 0:
+            for n, subproj, msg in failures:
+                print ("Worker " + str(n) + " failed on " + self.vss_path(subproj) + ": " + msg)
+            self.fatal_error(str(len(failures)) + " of " + str(len(workers)) + " workers failed", self.vss_proj, "")
+    ###########################################################################
+    # main                                                                    #
+    ###########################################################################
+    def run(self):
+        # sync the vss project to the head of the git branch
+        self.reset()
+        cwd = os.getcwd()
+        try:
+            self.run_sync()
+        finally:
+            self.listing_stop()
+            os.chdir(cwd)
+    def run_sync(self):
+        # setup windows cmd code point (fixes encoding errors)
+        subprocess.call("chcp {}".format(cmd_encoding), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=True)
+        # setup git repository
+        if os.path.exists(self.base_dir):
+            self.git_fetch()
+        else:
+            self.git_clone()
+        os.chdir(self.base_dir)
+        self.git_sparse_init()
+        print ("Changing to remotes/origin/{} branch".format(self.git_branch))
+        self.git_call(cmd_git_ckout.format("remotes/origin/" + self.git_branch), quiet=True, check=True)
+        self.vss_cd_root()
+        print ("Reading VSS project tree of " + self.vss_proj)
+        self.vss_snap_load()
+        # get changes since last sync commit hash
+        sync_commit = self.vss_git_hash_get()
+        if sync_commit is not None:
+            self.git_deepen(sync_commit)
+        self.manifest_load(sync_commit)
+        hash = self.git_hash().strip()
+        # sync, one .gitcommit update per target; git lists the changes of the
+        # next target while vss works on the current one
+        targets = self.sync_targets(sync_commit, hash)
+        listed = None
+        for i, target in enumerate(targets):
+            following = None
+            if i + 1 < len(targets):
+                following = self.git_changes_prefetch(target, targets[i + 1])
+            self.sync(sync_commit, target, listed)
+            sync_commit = target
+            listed = following
+        if self.dry_run:
+            self.plan_estimate()
+            print ("Dry run, VSS was not changed")
+            return
+        # create git tag
+        if self.git_tag is not None:
+            print ("Creating git tag {}".format(self.git_tag))
+            self.git_call(cmd_git_tag.format(self.git_tag))
+            print ("Pushing git tag")
+            self.git_call(cmd_git_push)
+        self.trace_write("ok")
+        print ("Done!")
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+# Runs sync-git-vss.py for many git branch -> VSS project mappings.           #
+###############################################################################
+# Usage: python sync-git-vss-daemon.py [--once] config.json                   #
+#                                                                             #
+# The config is a JSON object:                                                #
+#   workdir             folder of the warm clones, caches and logs;           #
+#   interval            seconds between the starts of two rounds [300];       #
+#   syncs_per_database  syncs running at once on one VSS database [1];        #
+#   options             options of every sync, e.g. ["--batch"];              #
+#   metrics_dir         folder of the Prometheus textfiles [optional];        #
+#   mappings            list of objects with repo, branch, project, user,     #
+#                       password, and optionally tag, sspath (the VSS         #
+#                       database, default %SSPATH%) and options.              #
+#                                                                             #
+# Each round fetches every repository once into a bare cache, fetching only   #
+# the branches that are mapped, then syncs each mapping from its own warm     #
+# clone of the cache, unless its branch has not moved since its last sync.    #
+# Syncs of the same commits share their git change set.                       #
+###############################################################################
+
+###############################################################################
+# imports                                                                     #
+###############################################################################
+import sys
+import os
+import json
+import time
+import hashlib
+import subprocess
+import threading
+
+###############################################################################
+# cli options---any argument of the form --name or --name=value               #
+###############################################################################
+opts = dict()
+args = [sys.argv[0]]
+for arg in sys.argv[1:]:
+    if arg.startswith("--"):
+        name, _, value = arg[2:].partition("=")
+        opts[name] = value
+    else:
+        args.append(arg)
+if len(args) < 2:
+    print ("Usage: python {} [--once] config.json".format(sys.argv[0]))
+    sys.exit(1)
+
+###############################################################################
+# config                                                                      #
+###############################################################################
+with open(args[1], "r", encoding="utf8") as f:
+    config = json.load(f)
+workdir     = config["workdir"]
+interval    = config.get("interval", 300)
+per_db      = config.get("syncs_per_database", 1)
+options     = config.get("options", [])
+metrics_dir = config.get("metrics_dir")
+mappings    = config["mappings"]
+script      = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sync-git-vss.py")
+repos_dir   = os.path.join(workdir, "repos")
+clones_dir  = os.path.join(workdir, "clones")
+logs_dir    = os.path.join(workdir, "logs")
+changes_dir = os.path.join(workdir, "changes")
+changes_age = 7 * 24 * 3600 # cached change sets older than this are removed
+
+###############################################################################
+# git command templates                                                       #
+###############################################################################
+cmd_git_init  = ['git', 'init', '--bare', '--quiet']
+cmd_git_fetch = ['git', 'fetch', '--quiet', '--prune']
+cmd_git_push  = ['git', 'push', '--quiet']
+cmd_git_head  = ['git', 'rev-parse', '--verify', '--quiet']
+
+###############################################################################
+# scheduling---one semaphore per vss database                                 #
+###############################################################################
+db_semaphores = dict()
+print_lock    = threading.Lock()
+synced        = dict() # mapping -> commit of its last successful sync
+
+###############################################################################
+# helper functions                                                            #
+###############################################################################
+def log(msg):
+    with print_lock:
+        print (time.strftime("%Y-%m-%d %H:%M:%S") + " " + msg)
+        sys.stdout.flush()
+def key(*fields):
+    # short stable name, without the credentials of repository urls
+    return hashlib.sha1("\n".join(fields).encode("utf8")).hexdigest()[:12]
+def mapping_sspath(mapping):
+    return mapping.get("sspath") or os.environ.get("SSPATH", "")
+def mapping_name(mapping):
+    return mapping["branch"] + " -> " + mapping["project"]
+def repo_cache(repo):
+    return os.path.join(repos_dir, key(repo) + ".git")
+def repo_fetch(repo, branches):
+    # one fetch of the mapped branches into the bare cache of repo
+    cache = repo_cache(repo)
+    if not os.path.isdir(cache):
+        os.makedirs(cache)
+        subprocess.call(cmd_git_init, cwd=cache)
+    refspecs = ["+refs/heads/{0}:refs/heads/{0}".format(branch) for branch in sorted(branches)]
+    return subprocess.call(cmd_git_fetch + [repo] + refspecs, cwd=cache) == 0
+def repo_head(repo, branch):
+    proc = subprocess.run(cmd_git_head + ["refs/heads/" + branch], cwd=repo_cache(repo), stdout=subprocess.PIPE)
+    return proc.stdout.decode("utf8").strip()
+def db_semaphore(sspath):
+    with print_lock:
+        return db_semaphores.setdefault(os.path.normcase(os.path.abspath(sspath)), threading.BoundedSemaphore(per_db))
+def sync_mapping(mapping):
+    name = key(mapping["repo"], mapping["branch"], mapping_sspath(mapping), mapping["project"])
+    head = repo_head(mapping["repo"], mapping["branch"])
+    if synced.get(name) == head: # nothing new since the last round
+        return
+    cmd = [sys.executable, script, os.path.join(clones_dir, name), repo_cache(mapping["repo"]), mapping["branch"],
+           mapping["project"], mapping["user"], mapping["password"]]
+    if mapping.get("tag"):
+        cmd.append(mapping["tag"])
+    cmd = cmd + options + mapping.get("options", []) + ["--changes-cache=" + changes_dir]
+    if metrics_dir is not None:
+        cmd.append("--metrics=" + os.path.join(metrics_dir, "git-vss-" + name + ".prom"))
+    env = dict(os.environ)
+    env["SSPATH"] = mapping_sspath(mapping)
+    with db_semaphore(env["SSPATH"]): # the database is shared with other mappings
+        log("Syncing " + mapping_name(mapping))
+        start = time.time()
+        with open(os.path.join(logs_dir, name + ".log"), "a", encoding="utf8") as f:
+            f.write("==== " + time.strftime("%Y-%m-%d %H:%M:%S") + " " + mapping_name(mapping) + "\n")
+            f.flush()
+            result = subprocess.call(cmd, env=env, stdout=f, stderr=subprocess.STDOUT)
+    if result != 0:
+        log("Failed " + mapping_name(mapping) + " after " + str(round(time.time() - start)) + "s, see " + os.path.join(logs_dir, name + ".log"))
+        return
+    log("Synced " + mapping_name(mapping) + " in " + str(round(time.time() - start)) + "s")
+    synced[name] = head
+    if mapping.get("tag"): # the sync pushed the tag to the cache, forward it
+        subprocess.call(cmd_git_push + [mapping["repo"], "refs/tags/" + mapping["tag"]], cwd=repo_cache(mapping["repo"]))
+def sync_repo(repo, repo_mappings):
+    if not repo_fetch(repo, set(mapping["branch"] for mapping in repo_mappings)):
+        log("Could not fetch " + repo_cache(repo) + ", skipping its " + str(len(repo_mappings)) + " mappings")
+        return
+    threads = [threading.Thread(target=sync_mapping, args=(mapping,)) for mapping in repo_mappings]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+def changes_prune():
+    for name in os.listdir(changes_dir):
+        path = os.path.join(changes_dir, name)
+        try:
+            if time.time() - os.path.getmtime(path) > changes_age:
+                os.remove(path)
+        except OSError: # in use or gone
+            pass
+def sync_round():
+    repos = dict()
+    for mapping in mappings:
+        repos.setdefault(mapping["repo"], []).append(mapping)
+    threads = [threading.Thread(target=sync_repo, args=(repo, repo_mappings)) for repo, repo_mappings in repos.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    changes_prune()
+
+###############################################################################
+# main                                                                        #
+###############################################################################
+for path in (repos_dir, clones_dir, logs_dir, changes_dir):
+    os.makedirs(path, exist_ok=True)
+if metrics_dir is not None:
+    os.makedirs(metrics_dir, exist_ok=True)
+log("Serving " + str(len(mappings)) + " mappings, every " + str(interval) + "s")
+while True:
+    start = time.time()
+    sync_round()
+    if "once" in opts:
+        break
+    time.sleep(max(0, interval - (time.time() - start)))